@@ -19,6 +19,9 @@
 #
 
 import os
+import json
+import shutil
+import subprocess
 import logging as log
 from logging import debug as D
 from logging import info as I
@@ -28,54 +31,157 @@ from logging import critical as C
 import sys
 
 from errors import *
-from utils.git import Git
 from utils.bitbake import *
 
+def _import_buildhistory_analysis():
+    # the analysis lives in the oe library of the metadata, next to the
+    # scripts directory of buildhistory-diff
+    script = shutil.which("buildhistory-diff")
+    if script is None:
+        return None
+
+    lib_dir = os.path.join(os.path.dirname(os.path.realpath(script)),
+            "..", "meta", "lib")
+    if not lib_dir in sys.path:
+        sys.path.insert(0, lib_dir)
+
+    try:
+        import oe.buildhistory_analysis
+    except ImportError as e:
+        D(" Can't import oe.buildhistory_analysis: %s" % str(e))
+        return None
+
+    return oe.buildhistory_analysis
+
+def _summarize_changes(changes):
+    summary = {'pkgsize': {}, 'files_added': {}, 'files_removed': {}}
+
+    for chg in changes:
+        if chg.fieldname == 'PKGSIZE':
+            try:
+                old = int(chg.oldvalue or 0)
+                new = int(chg.newvalue or 0)
+            except ValueError:
+                continue
+            summary['pkgsize'][chg.path] = {'old': old, 'new': new,
+                                            'delta': new - old}
+        elif chg.fieldname == 'FILELIST':
+            old = set((chg.oldvalue or '').split())
+            new = set((chg.newvalue or '').split())
+            if new - old:
+                summary['files_added'][chg.path] = sorted(new - old)
+            if old - new:
+                summary['files_removed'][chg.path] = sorted(old - new)
+
+    return summary
+
+# the buildhistory repository is shared by the recipes of a run, the
+# commits of every recipe and machine are tagged as <pn>/<machine>/<n>
 class BuildHistory(object):
-    def __init__(self, bb, pn, workdir):
+    def __init__(self, bb, pn, workdir, git):
         self.bb = bb
         self.pn = pn
         self.workdir = workdir
-        self.revs = []
+        # (commit before, commit of) every build of a machine
+        self.revs = {}
+        self.head = None
+
+        self.git = git
+        self.buildhistory_dir = git.repo_dir
 
-        self.buildhistory_dir = os.path.join(self.workdir, 'buildhistory')
-        if not os.path.exists(self.buildhistory_dir):
-            os.mkdir(self.buildhistory_dir)
+    def get_env(self):
+        return {'BUILDHISTORY_DIR': self.buildhistory_dir}
 
-        self.git = Git(self.buildhistory_dir)
+    def _get_head(self):
+        try:
+            return self.git.last_commit("HEAD")
+        except Error:
+            # nothing committed yet
+            return None
 
-        os.environ['BB_ENV_EXTRAWHITE'] = os.environ['BB_ENV_EXTRAWHITE'] + \
-                                    " BUILDHISTORY_DIR"
-        os.environ["BUILDHISTORY_DIR"] = self.buildhistory_dir
+    def _tag(self, machine):
+        rev = self._get_head()
+        builds = self.revs.setdefault(machine, [])
+        if rev is not None:
+            self.git.tag("%s/%s/%d" % (self.pn, machine, len(builds)), rev)
+        builds.append((self.head, rev))
+        self.head = rev
 
     def init(self, machines):
         self.bb.cleanall(self.pn)
+        self.head = self._get_head()
         for machine in machines:
-            self.bb.complete(self.pn, machine)
-            self.revs.append(self.git.last_commit("master"))
+            self.bb.complete(self.pn, machine, self.get_env())
+            self._tag(machine)
 
-    def add(self):
-        self.revs.append(self.git.last_commit("master"))
+    def add(self, machine):
+        self._tag(machine)
+
+    def _diff_tool(self, rev_initial, rev_final):
+        file_path = os.path.join(self.workdir, "buildhistory-diff.txt")
+        cmd = "buildhistory-diff -p %s %s %s" % (self.buildhistory_dir,
+                rev_initial, rev_final)
+        with open(file_path, "a+") as f:
+            ret = subprocess.call(cmd, shell=True, stdout=f,
+                    stderr=subprocess.PIPE)
+        if ret != 0:
+            W("%s: Buildhistory checking fails, see %s" % (self.pn, cmd))
 
     def diff(self):
-        rev_initial = self.revs[0]
-        rev_final = self.revs[-1]
+        analysis = _import_buildhistory_analysis()
+        if analysis is None:
+            W("%s: oe.buildhistory_analysis isn't available, running " \
+                    "buildhistory-diff only for the significant changes" %
+                    self.pn)
 
-        try:
-            cmd = "buildhistory-diff -p %s %s %s"  % (self.buildhistory_dir, 
-                rev_initial, rev_final)
-            stdout, stderr = bb.process.run(cmd)
-            if stdout and os.path.exists(self.workdir):
-                with open(os.path.join(self.workdir, "buildhistory-diff.txt"),
-                        "w+") as log:
-                    log.write(stdout)
-
-            cmd_full = "buildhistory-diff -a -p %s %s %s"  % (self.buildhistory_dir, 
-                        rev_initial, rev_final)
-            stdout, stderr = bb.process.run(cmd_full)
-            if stdout and os.path.exists(self.workdir):
-                with open(os.path.join(self.workdir, "buildhistory-diff-full.txt"),
-                        "w+") as log:
-                    log.write(stdout)
-        except bb.process.ExecutionError as e:
-            W( "%s: Buildhistory checking fails\n%s" % (self.pn, e.stdout))
+        diff_file = os.path.join(self.workdir, "buildhistory-diff.txt")
+        diff_full_file = os.path.join(self.workdir, "buildhistory-diff-full.txt")
+        summary = {}
+
+        # the builds of the other machines are committed between the
+        # initial and the upgraded build of a machine, so the upgraded build
+        # is compared with the commit before it, where the paths of the
+        # machine are the ones of its initial build
+        with open(diff_file, "w+") as df, open(diff_full_file, "w+") as dff:
+            for machine in self.revs:
+                if len(self.revs[machine]) < 2:
+                    continue
+                rev_initial, rev_final = self.revs[machine][-1]
+                if rev_initial is None or rev_initial == rev_final:
+                    continue
+
+                if analysis is None:
+                    df.flush()
+                    self._diff_tool(rev_initial, rev_final)
+                    continue
+
+                # the significant changes are the ones of buildhistory-diff
+                # without -a, including the related changes it links
+                try:
+                    significant = analysis.process_changes(
+                            self.buildhistory_dir, rev_initial, rev_final)
+                    changes = analysis.process_changes(self.buildhistory_dir,
+                            rev_initial, rev_final, True)
+                except Exception as e:
+                    W("%s: Buildhistory checking fails for %s\n%s" %
+                            (self.pn, machine, str(e)))
+                    continue
+
+                for f, chgs in ((df, significant), (dff, changes)):
+                    for chg in chgs:
+                        out = str(chg)
+                        if out:
+                            f.write(out + "\n")
+
+                summary[machine] = _summarize_changes(changes)
+
+        for file_path in (diff_file, diff_full_file):
+            if os.path.getsize(file_path) == 0:
+                os.remove(file_path)
+
+        if summary:
+            with open(os.path.join(self.workdir, "buildhistory-summary.json"),
+                    "w+") as f:
+                json.dump(summary, f, indent=4, sort_keys=True)
+
+        return summary
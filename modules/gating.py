@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# vim: set ts=4 sw=4 et:
+#
+# Copyright (c) 2015 Intel Corporation
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# This module decides which recipes are attempted, the rules are compiled
+# once from the configuration: blacklist, maintainers whitelist, history
+# and retry policies.
+#
+
+import re
+import fnmatch
+from datetime import date
+from datetime import datetime
+from logging import debug as D
+from logging import error as E
+
+import errors
+from errors import *
+
+# skip reason codes
+SKIP_NO_MAINTAINER = "no-maintainer"
+SKIP_BLACKLIST = "blacklist"
+SKIP_NOT_WHITELISTED = "maintainer-not-whitelisted"
+SKIP_HISTORY = "history"
+SKIP_CROSS_NATIVE = "cross-native"
+SKIP_FAILURE_STREAK = "failure-streak"
+
+# failure class -> days to wait before retrying the same version
+DEFAULT_RETRY_POLICY = "FetchError:30 Error:30"
+
+def _get_error_statuses():
+    statuses = {}
+
+    for name, cls in vars(errors).items():
+        if isinstance(cls, type) and issubclass(cls, Error):
+            statuses[name] = str(cls.__new__(cls))
+
+    return statuses
+
+def _settings_error(msg):
+    E(" %s\n" % msg)
+    exit(1)
+
+def _get_days(setting, value):
+    try:
+        days = int(value)
+    except ValueError:
+        days = -1
+    if days < 0:
+        _settings_error("Invalid number of days %s in %s" % (value, setting))
+    return days
+
+class UpgradeRules(object):
+    def __init__(self, settings, history, failure_streaks=None):
+        self.blacklist = set()
+        blacklist_globs = []
+        for p in settings.get("blacklist", "").split():
+            if re.search("[*?\[]", p):
+                blacklist_globs.append(fnmatch.translate(p))
+            else:
+                self.blacklist.add(p)
+        self.blacklist_re = None
+        if blacklist_globs:
+            self.blacklist_re = re.compile('|'.join(blacklist_globs))
+
+        # an empty whitelist doesn't allow any maintainer
+        self.whitelist_re = None
+        if "maintainers_whitelist" in settings:
+            patterns = [re.escape(m).replace("\\*", ".*")
+                        for m in settings["maintainers_whitelist"].split()]
+            self.whitelist_re = re.compile('|'.join(patterns) or "(?!)")
+
+        # the history only records the status, classes sharing it (e.g.
+        # Error, MaintainerError and IntegrationError) can't have a policy
+        # each
+        error_statuses = _get_error_statuses()
+        self.retry_policy = {}
+        policy_classes = {}
+        for policy in settings.get("retry_policy", DEFAULT_RETRY_POLICY).split():
+            name, _, days = policy.partition(':')
+            if name not in error_statuses:
+                _settings_error("Unknown failure class %s in retry_policy" %
+                        name)
+            status = error_statuses[name]
+            if status in policy_classes:
+                _settings_error("Failure classes %s and %s in retry_policy "
+                        "share the status %s, use only one of them" %
+                        (policy_classes[status], name, status))
+            policy_classes[status] = name
+            self.retry_policy[status] = _get_days("retry_policy", days)
+
+        self.today = date.toordinal(date.today())
+        self.history = {}
+        for pn in history.entries:
+            version, _, tried_date, status = history[pn]
+            self.history[pn] = (version, status, date.toordinal(
+                datetime.strptime(tried_date, '%Y-%m-%d')))
+
+        # consecutive failed runs of a recipe before it isn't attempted
+        try:
+            self.max_failure_streak = int(settings.get("max_failure_streak",
+                "0"))
+        except ValueError:
+            _settings_error("max_failure_streak must be a number")
+        self.failure_streaks = failure_streaks or {}
+
+        self.skipped = {}
+
+    def _skip(self, pn, reason, msg):
+        D(" Skipping upgrade of %s: %s" % (pn, msg))
+        self.skipped[pn] = (reason, msg)
+        return False
+
+    def upgradable(self, pn, next_ver, maintainer):
+        if not maintainer:
+            return self._skip(pn, SKIP_NO_MAINTAINER, "no maintainer")
+
+        if pn in self.blacklist or \
+                (self.blacklist_re and self.blacklist_re.match(pn)):
+            return self._skip(pn, SKIP_BLACKLIST, "blacklist")
+
+        if self.whitelist_re and not self.whitelist_re.search(maintainer):
+            return self._skip(pn, SKIP_NOT_WHITELISTED,
+                    "maintainer \"%s\" not in whitelist" % maintainer)
+
+        if pn in self.history:
+            version, status, tried = self.history[pn]
+            # did we already try this version?
+            if next_ver == version:
+                days = self.retry_policy.get(status)
+                if days is not None and self.today - tried > days:
+                    return True
+
+                return self._skip(pn, SKIP_HISTORY,
+                        "is in history (%s) and retry policy doesn't allow it" %
+                        status)
+
+        # a new version is attempted again
+        if self.max_failure_streak and pn in self.failure_streaks:
+            version, failures = self.failure_streaks[pn]
+            if version == next_ver and failures >= self.max_failure_streak:
+                return self._skip(pn, SKIP_FAILURE_STREAK,
+                        "%s failed in the last %d runs" % (version, failures))
+
+        # drop native/cross/cross-canadian recipes. We deal with native
+        # when upgrading the main recipe but we keep away of cross* pkgs...
+        # for now
+        if pn.find("cross") != -1 or pn.find("native") != -1:
+            return self._skip(pn, SKIP_CROSS_NATIVE, "is cross or native")
+
+        return True
+
+    def write_skipped(self, file_path):
+        with open(file_path, "w+") as f:
+            for pn in sorted(self.skipped):
+                f.write("%s\t%s\t%s\n" % (pn, self.skipped[pn][0],
+                    self.skipped[pn][1]))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# vim: set ts=4 sw=4 et:
+#
+# Copyright (c) 2015 Intel Corporation
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# This module implements the history of upgrade attempts, entries are
+# appended to the history file and the last entry of a recipe wins, the
+# file is compacted when loaded if it has grown with superseded entries.
+#
+
+import os
+from datetime import date
+from logging import debug as D
+
+# compact when the file has more than this number of superseded entries
+HISTORY_COMPACT_THRESHOLD = 1000
+
+class History(object):
+    def __init__(self, history_file):
+        self.history_file = history_file
+        self.entries = dict()
+
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.history_file):
+            return
+
+        lines = 0
+        with open(self.history_file) as f:
+            for line in f:
+                fields = line.rstrip('\n').split(',', 4)
+                if len(fields) != 5:
+                    continue
+
+                lines += 1
+                self.entries[fields[0]] = fields[1:]
+
+        if lines - len(self.entries) > HISTORY_COMPACT_THRESHOLD:
+            self.compact()
+
+    def _format(self, pn, entry):
+        return ','.join([pn] + entry) + '\n'
+
+    def compact(self):
+        D(" Compacting history file %s ..." % self.history_file)
+
+        with open(self.history_file + ".tmp", "w+") as f:
+            for pn in sorted(self.entries):
+                f.write(self._format(pn, self.entries[pn]))
+        os.rename(self.history_file + ".tmp", self.history_file)
+
+    def update(self, pn, new_ver, maintainer, upgrade_status):
+        entry = [new_ver, maintainer, date.isoformat(date.today()),
+                 upgrade_status]
+        self.entries[pn] = entry
+
+        with open(self.history_file, "a") as f:
+            f.write(self._format(pn, entry))
+
+    def __contains__(self, pn):
+        return pn in self.entries
+
+    def __getitem__(self, pn):
+        return self.entries[pn]
@@ -25,6 +25,7 @@
 import os
 import re
 import sys
+import difflib
 import logging as log
 from logging import debug as D
 from logging import info as I
@@ -33,6 +34,34 @@ from logging import warning as W
 from errors import *
 from utils.bitbake import *
 
+# license diffs are attached to the maintainer email, bigger diffs are
+# truncated and summarized
+LICENSE_DIFF_MAX_SIZE = 256 * 1024
+
+# bitbake directory variables used to express not shipped files in
+# FILES_${PN}, defaults are used when the variable isn't in the environment
+BITBAKE_DIR_VARS = [
+    ("prefix", "/usr"),
+    ("exec_prefix", "/usr"),
+    ("base_bindir", "/bin"),
+    ("base_sbindir", "/sbin"),
+    ("base_libdir", "/lib"),
+    ("nonarch_base_libdir", "/lib"),
+    ("datadir", "/usr/share"),
+    ("sysconfdir", "/etc"),
+    ("localstatedir", "/var"),
+    ("infodir", "/usr/share/info"),
+    ("mandir", "/usr/share/man"),
+    ("docdir", "/usr/share/doc"),
+    ("servicedir", "/srv"),
+    ("systemd_unitdir", "/lib/systemd"),
+    ("bindir", "/usr/bin"),
+    ("sbindir", "/usr/sbin"),
+    ("libexecdir", "/usr/libexec"),
+    ("libdir", "/usr/lib"),
+    ("includedir", "/usr/include"),
+]
+
 def is_recipe_or_include_file(env, full_path_f, f):
     is_file = os.path.isfile(full_path_f)
 
@@ -86,6 +115,8 @@ class Recipe(object):
 
         self.removed_patches = False
 
+        self.not_shipped_added = set()
+
         self.suffixes = [
             "tar.gz", "tgz", "zip", "tar.bz2", "tar.xz", "tar.lz4", "bz2",
             "lz4", "orig.tar.gz", "src.tar.gz", "src.rpm", "src.tgz",
@@ -152,16 +183,92 @@ class Recipe(object):
         # since we did some renaming, backup the current environment
         self.old_env = self.env
 
+    def _get_license_range(self, file):
+        beginline = None
+        endline = None
+
+        for uri in self.env.get('LIC_FILES_CHKSUM', '').split():
+            if not uri.startswith("file://"):
+                continue
+
+            params = uri[len("file://"):].split(';')
+            if params[0] != file:
+                continue
+
+            for param in params[1:]:
+                key, _, value = param.partition('=')
+                if key == "beginline" and value:
+                    beginline = int(value)
+                elif key == "endline" and value:
+                    endline = int(value)
+            break
+
+        return (beginline, endline)
+
+    def _read_license_lines(self, path, beginline, endline):
+        lines = []
+
+        if not os.path.isfile(path):
+            return lines
+
+        with open(path, errors="replace") as f:
+            for n, line in enumerate(f, 1):
+                if beginline is not None and n < beginline:
+                    continue
+                if endline is not None and n > endline:
+                    break
+                lines.append(line)
+
+        return lines
+
     def create_diff_file(self, file, old_md5, new_md5):
         old_file = os.path.join(self.old_env['S'], file)
         new_file = os.path.join(self.env['S'], file)
-        cmd = "diff -Nup " + old_file + " " + new_file + " > " + \
-              os.path.join(self.workdir, os.path.basename(file + ".diff"))
+        diff_file = os.path.join(self.workdir, os.path.basename(file + ".diff"))
+
+        beginline, endline = self._get_license_range(file)
+        old_lines = self._read_license_lines(old_file, beginline, endline)
+        new_lines = self._read_license_lines(new_file, beginline, endline)
+
+        size = 0
+        in_hunk = False
+        truncated = False
+        added = 0
+        removed = 0
+        with open(diff_file, "w+") as f:
+            for line in difflib.unified_diff(old_lines, new_lines,
+                    old_file, new_file, n=3):
+                if not line.endswith('\n'):
+                    line += "\n\\ No newline at end of file\n"
+
+                if line.startswith('@@'):
+                    in_hunk = True
+                    # hunk ranges are relative to beginline, report them
+                    # as file line numbers
+                    if beginline:
+                        line = re.sub("([-+])([0-9]+)",
+                                lambda m: m.group(1) + str(int(m.group(2)) +
+                                    beginline - 1), line)
+                elif in_hunk:
+                    if line.startswith('+'):
+                        added += 1
+                    elif line.startswith('-'):
+                        removed += 1
+
+                if truncated:
+                    continue
 
-        try:
-            stdout, stderr = bb.process.run(cmd)
-        except bb.process.ExecutionError:
-            pass
+                size += len(line)
+                if size > LICENSE_DIFF_MAX_SIZE:
+                    truncated = True
+                    continue
+
+                f.write(line)
+
+            if truncated:
+                f.write("\n*** Diff truncated, exceeds %d bytes: %d line(s)"
+                        " added, %d line(s) removed in total ***\n" %
+                        (LICENSE_DIFF_MAX_SIZE, added, removed))
 
         with open(os.path.join(self.workdir, "license_checksums.txt"), "w+") as f:
             f.write("old checksum = %s\n" % old_md5)
@@ -481,109 +588,109 @@ class Recipe(object):
 
         return False
 
-    def _add_not_shipped(self, package_log):
-        files_not_shipped = False
+    def _get_dir_trie(self):
+        trie = {}
+
+        for var, default in BITBAKE_DIR_VARS:
+            path = self.env.get(var, default)
+            if not os.path.isabs(path):
+                continue
+
+            node = trie
+            for component in path.strip('/').split('/'):
+                if component:
+                    node = node.setdefault(component, {})
+            node.setdefault('', var)
+
+        return trie
+
+    def _get_not_shipped_files(self, package_log):
         files = []
-        occurences = []
-        prefixes = {
-          "/usr"            : "prefix",
-          "/bin"            : "base_bindir",
-          "/sbin"           : "base_sbindir",
-          "/lib"            : "base_libdir",
-          "/usr/share"      : "datadir",
-          "/etc"            : "sysconfdir",
-          "/var"            : "localstatedir",
-          "/usr/share/info" : "infodir",
-          "/usr/share/man"  : "mandir",
-          "/usr/share/doc"  : "docdir",
-          "/srv"            : "servicedir",
-          "/usr/bin"        : "bindir",
-          "/usr/sbin"       : "sbindir",
-          "/usr/libexec"    : "libexecdir",
-          "/usr/lib"        : "libdir",
-          "/usr/include"    : "includedir",
-          "/usr/lib/opie"   : "palmtopdir",
-          "/usr/lib/opie"   : "palmqtdir",
-        }
+        files_not_shipped = False
 
         with open(package_log) as log:
             for line in log:
                 if re.match(".*Files/directories were installed but not shipped.*", line):
-                    I(" %s: Add new files in recipe ..." %  self.env['PN'])
+                    # the log could contain more than one run, keep the last one
+                    files = []
                     files_not_shipped = True
-                # Extract path
+                    continue
+
+                if not files_not_shipped:
+                    continue
+
                 line = line.strip()
                 if line:
                     line = line.split()[0]
-                if files_not_shipped and os.path.isabs(line):
-                    # Count occurences for globbing
-                    path_exists = False
-                    for i in range(0, len(files)):
-                        if line.find(files[i]) == 0:
-                            path_exists = True
-                            occurences[i] += 1
-                            break
-                    if not path_exists:
-                        files.append(line)
-                        occurences.append(1)
-
-        for i in range(0, len(files)):
-            # Change paths to globbing expressions where is the case
-            if occurences[i] > 1:
-                files[i] += "/*"
-            largest_prefix = ""
-            # Substitute prefix
-            for prefix in prefixes:
-                if files[i].find(prefix) == 0 and len(prefix) > len(largest_prefix):
-                    largest_prefix = prefix
-            if largest_prefix:
-                replacement = "${" + prefixes[largest_prefix] + "}"
-                files[i] = files[i].replace(largest_prefix, replacement)
-
-        @modify_recipe_files
-        def _append_new_files(line, temp_recipe, *args, **kwargs):
-            d = args[0]
+                if os.path.isabs(line):
+                    files.append(line)
+                elif files:
+                    files_not_shipped = False
+
+        return files
+
+    def _group_not_shipped(self, files):
+        trie = self._get_dir_trie()
+        groups = {}
+
+        # every path is classified walking the trie once, groups are
+        # keyed by the first component after the bitbake directory
+        for path in files:
+            components = [c for c in path.split('/') if c]
+
+            node = trie
+            var = None
+            depth = 0
+            for i, component in enumerate(components):
+                if component not in node:
+                    break
+                node = node[component]
+                if '' in node:
+                    var = node['']
+                    depth = i + 1
 
-            if re.match("^FILES_\${PN}[ +=].*", line):
-                d['files_clause'] = True
-                temp_recipe.write(line)
-                return
+            if var is not None:
+                base = "${" + var + "}"
+            else:
+                base = ""
+            rest = components[depth:]
 
-            # Get front spacing
-            if d['files_clause']:
-                front_spacing = re.sub("[^ \t]", "", line)
+            if not rest:
+                key = (base, None)
+                entry = base
+            else:
+                key = (base, rest[0])
+                entry = base + '/' + '/'.join(rest)
 
-            # Append once the last line has of FILES has been reached
-            if re.match(".*\".*", line) and d['files_clause']:
-                d['files_clause'] = False
-                line = line.replace("\"", "")
-                line = line.rstrip()
-                front_spacing = re.sub("[^ \t]", "", line)
+            if key in groups:
+                groups[key] = base + '/' + rest[0]
+            else:
+                groups[key] = entry
 
-                # Do not write an empty line
-                if line.strip():
-                    temp_recipe.write(line + " \\\n")
+        return list(groups.values())
 
-                # Add spacing in case there was none
-                if len(front_spacing) == 0:
-                    front_spacing = " " * 8
+    def _add_not_shipped(self, package_log):
+        files = self._get_not_shipped_files(package_log)
+        if not files:
+            return False
 
-                # Write to file
-                for i in range(len(files) - 1):
-                    line = front_spacing + files[i] + " \\\n"
-                    temp_recipe.write(line)
+        entries = [e for e in self._group_not_shipped(files)
+                    if e not in self.not_shipped_added]
+        if not entries:
+            return False
 
-                line = front_spacing + files[len(files) - 1] + "\"\n"
-                temp_recipe.write(line)
-                return
+        I(" %s: Add new files in recipe: %s ..." % (self.env['PN'],
+            ' '.join(entries)))
 
-            temp_recipe.write(line)
+        with open(self.env['FILE'], "a") as recipe:
+            recipe.write("\nFILES_${PN} += \" \\\n")
+            for entry in entries:
+                recipe.write("    %s \\\n" % entry)
+            recipe.write("\"\n")
 
-        d = {}
-        d['files_clause'] = False
-        _append_new_files(self.env, self.recipe_dir, d)
+        self.not_shipped_added.update(entries)
 
-        return files_not_shipped
+        return True
 
     def unpack(self):
         self.bb.unpack(self.env['PN'])
@@ -659,9 +766,9 @@ class Recipe(object):
             self.git.reset_soft(1)
             self.removed_patches = False
 
-    def compile(self, machine):
+    def compile(self, machine, env=None):
         try:
-            self.bb.complete(self.env['PN'], machine)
+            self.bb.complete(self.env['PN'], machine, env)
             if self.removed_patches:
                 # move temporary changes into upgrades branch
                 self.git.checkout_branch("upgrades")
@@ -680,7 +787,7 @@ class Recipe(object):
                     raise CompilationError()
 
                 # retry
-                self.compile(machine)
+                self.compile(machine, env)
             else:
                 failed_task = failed_recipes[self.env['PN']][0]
                 log_file = failed_recipes[self.env['PN']][1]
@@ -689,7 +796,7 @@ class Recipe(object):
                     # Comment one patch after the other until
                     # compilation works.
                     if not self.removed_patches:
-                        self.git.commit("temporary")
+                        self.git.commit("temporary", paths=[self.recipe_dir])
                         self.git.create_branch("comment_patches")
                         self.git.checkout_branch("comment_patches")
                         self.removed_patches = True
@@ -700,7 +807,7 @@ class Recipe(object):
 
                     # retry
                     I(" %s: Recompiling for %s ..." % (self.env['PN'], machine))
-                    self.compile(machine)
+                    self.compile(machine, env)
                 elif failed_task == "do_configure":
                     self._undo_temporary()
                     if not self._is_license_issue(log_file):
@@ -709,14 +816,16 @@ class Recipe(object):
                     if not self._license_issue_handled(log_file):
                         raise LicenseError()
                     #retry
-                    self.compile(machine)
+                    self.compile(machine, env)
                 elif failed_task == "do_fetch":
                     raise FetchError()
                 elif failed_task == "do_package":
-                    raise PackageError()
-                    #if self._add_not_shipped(log_file):
-                    #    self.compile(machine)
-                    #else:
+                    if not self._add_not_shipped(log_file):
+                        self._undo_temporary()
+                        raise PackageError()
+                    # retry
+                    I(" %s: Recompiling for %s ..." % (self.env['PN'], machine))
+                    self.compile(machine, env)
                 else:
                     self._undo_temporary()
                     # throw a compilation exception for everything else. It
@@ -27,8 +27,14 @@ import os
 
 from errors import *
 from recipe.base import Recipe
+from utils.tagcache import parse_ls_remote_tags, build_tag_index, \
+        find_tag_sha1
 
 class GitRecipe(Recipe):
+    def __init__(self, *args, **kwargs):
+        self.tag_cache = kwargs.pop('tag_cache', None)
+        super(GitRecipe, self).__init__(*args, **kwargs)
+
     def _extract_tag_from_ver(self, ver):
         m = re.match("(.*)\+.*\+.*", ver)
         if m is not None:
@@ -37,25 +43,21 @@ class GitRecipe(Recipe):
         # allow errors in the reporting system
         return ver
 
-    def _get_tag_sha1(self, new_tag):
+    def _get_repo_url(self):
         m = re.match(".*(git://[^ ;]*).*", self.env['SRC_URI'])
         if m is None:
             raise Error("could not extract repo url from SRC_URI")
 
-        repo_url = m.group(1)
-        tags = self.git.ls_remote(repo_url, "--tags")
+        return m.group(1)
 
-        # Try to find tag ending with ^{}
-        for tag in tags.split('\n'):
-            if tag.endswith(new_tag + "^{}"):
-                return tag.split()[0]
+    def _get_tag_sha1(self, new_tag):
+        repo_url = self._get_repo_url()
 
-        # If not found, try to find simple tag
-        for tag in tags.split('\n'):
-            if tag.endswith(new_tag):
-                return tag.split()[0]
+        if self.tag_cache is None:
+            tags = parse_ls_remote_tags(self.git.ls_remote(repo_url, "--tags"))
+            return find_tag_sha1(build_tag_index(tags), new_tag)
 
-        return None
+        return self.tag_cache.get_sha1(repo_url, new_tag)
 
     def rename(self):
         old_git_tag = self._extract_tag_from_ver(self.env['PKGV'])
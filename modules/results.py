@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# vim: set ts=4 sw=4 et:
+#
+# Copyright (c) 2015 Intel Corporation
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# This module exports the results of a run in machine readable formats,
+# the files are rewritten every time a recipe finishes so the progress of
+# a run can be followed.
+#
+
+import os
+import csv
+import json
+from datetime import datetime
+
+RESULTS_JSON = "results.json"
+RESULTS_CSV = "results.csv"
+
+RESULTS_CSV_COLUMNS = ['pn', 'status', 'error_class', 'current_version',
+                       'next_version', 'maintainer', 'duration', 'machines',
+                       'workdir']
+
+def _get_status(error):
+    if error is None:
+        return "Succeeded"
+    return str(error)
+
+def _get_artifacts(pkg_ctx):
+    artifacts = {}
+
+    workdir = pkg_ctx.get('workdir')
+    if not workdir or not os.path.exists(workdir):
+        return artifacts
+
+    artifacts['workdir'] = workdir
+    if pkg_ctx.get('patch_file'):
+        artifacts['patch'] = os.path.join(workdir, pkg_ctx['patch_file'])
+    if 'recipe' in pkg_ctx:
+        license_diff = pkg_ctx['recipe'].get_license_diff_file_name()
+        if license_diff:
+            artifacts['license_diff'] = os.path.join(workdir, license_diff)
+    for name in ("buildhistory-diff.txt", "buildhistory-summary.json",
+            "integration_error.log"):
+        if os.path.exists(os.path.join(workdir, name)):
+            artifacts[name.split('.')[0].replace('-', '_')] = \
+                os.path.join(workdir, name)
+    if 'ptest_log' in pkg_ctx:
+        artifacts['ptest_log'] = pkg_ctx['ptest_log']
+    if 'testimage_logs' in pkg_ctx:
+        artifacts['testimage_logs'] = pkg_ctx['testimage_logs']
+
+    return artifacts
+
+def _get_record(pkg_ctx):
+    error = pkg_ctx.get('error')
+    if 'integration_error' in pkg_ctx:
+        error = pkg_ctx['integration_error']
+
+    return {
+        'pn': pkg_ctx['PN'],
+        'status': _get_status(error),
+        'error_class': type(error).__name__ if error is not None else None,
+        'current_version': pkg_ctx.get('PV'),
+        'next_version': pkg_ctx['NPV'],
+        'maintainer': pkg_ctx['MAINTAINER'],
+        'step_durations': pkg_ctx.get('step_durations', {}),
+        'duration': sum(pkg_ctx.get('step_durations', {}).values()),
+        'disk_used': pkg_ctx.get('disk_used'),
+        'machines': pkg_ctx.get('machines_built', []),
+        'ptest': sorted(pkg_ctx.get('ptest', {}).keys()),
+        'testimage': sorted(pkg_ctx.get('testimage', {}).keys()),
+        'artifacts': _get_artifacts(pkg_ctx),
+    }
+
+class Results(object):
+    def __init__(self, results_dir, machines, write_csv=False, rundb=None):
+        self.results_dir = results_dir
+        self.write_csv = write_csv
+        self.rundb = rundb
+        self.records = {}
+        self.run = {
+            'run': os.path.basename(results_dir),
+            'started': datetime.now().isoformat(),
+            'finished': None,
+            'machines': machines,
+        }
+
+        if self.rundb is not None:
+            self.run_id = self.rundb.add_run(self.run)
+
+    def _write(self):
+        doc = dict(self.run)
+        doc['recipes'] = list(self.records.values())
+
+        json_file = os.path.join(self.results_dir, RESULTS_JSON)
+        with open(json_file + ".tmp", "w+") as f:
+            json.dump(doc, f, indent=4, sort_keys=True)
+        os.rename(json_file + ".tmp", json_file)
+
+        if not self.write_csv:
+            return
+
+        csv_file = os.path.join(self.results_dir, RESULTS_CSV)
+        with open(csv_file + ".tmp", "w+") as f:
+            writer = csv.writer(f, lineterminator='\n')
+            writer.writerow(RESULTS_CSV_COLUMNS)
+            for r in doc['recipes']:
+                writer.writerow([r['pn'], r['status'], r['error_class'] or '',
+                    r['current_version'] or '', r['next_version'],
+                    r['maintainer'], "%.1f" % r['duration'],
+                    ' '.join(r['machines']),
+                    r['artifacts'].get('workdir', '')])
+        os.rename(csv_file + ".tmp", csv_file)
+
+    def update(self, pkg_ctx):
+        record = _get_record(pkg_ctx)
+        self.records[pkg_ctx['PN']] = record
+        self._write()
+
+        if self.rundb is not None:
+            self.rundb.update_recipe(self.run_id, record)
+
+    def finish(self):
+        self.run['finished'] = datetime.now().isoformat()
+        self._write()
+
+        if self.rundb is not None:
+            self.rundb.finish_run(self.run_id, self.run['finished'])
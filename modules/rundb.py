@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# vim: set ts=4 sw=4 et:
+#
+# Copyright (c) 2015 Intel Corporation
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# This module keeps the outcome and timings of the recipes of every run in
+# a SQLite database, it's used to query trends across runs and by the
+# gating of upgrades.
+#
+
+import sqlite3
+
+from errors import *
+
+RUNDB_FILE = "upgrade-helper.db"
+# runs looked at by the queries
+RUNDB_QUERY_RUNS = 10
+# a recipe is reported as slower when it takes this times its average
+RUNDB_REGRESSION_FACTOR = 1.5
+# statuses that aren't failures of the recipe, left out of the failure
+# queries
+RUNDB_NOT_FAILURES = [str(UpgradeNotNeededError())]
+
+RUNDB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE,
+    started TEXT,
+    finished TEXT,
+    machines TEXT
+);
+CREATE TABLE IF NOT EXISTS recipes (
+    run_id INTEGER,
+    pn TEXT,
+    status TEXT,
+    error_class TEXT,
+    current_version TEXT,
+    next_version TEXT,
+    maintainer TEXT,
+    duration REAL,
+    disk_used INTEGER,
+    PRIMARY KEY (run_id, pn)
+);
+CREATE TABLE IF NOT EXISTS steps (
+    run_id INTEGER,
+    pn TEXT,
+    step TEXT,
+    duration REAL,
+    PRIMARY KEY (run_id, pn, step)
+);
+CREATE INDEX IF NOT EXISTS recipes_pn ON recipes (pn);
+"""
+
+class RunDatabase(object):
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+        self.conn.executescript(RUNDB_SCHEMA)
+        self.conn.commit()
+
+    def add_run(self, run):
+        with self.conn:
+            cur = self.conn.execute("INSERT OR REPLACE INTO runs " \
+                    "(name, started, finished, machines) VALUES (?, ?, ?, ?)",
+                    (run['run'], run['started'], run['finished'],
+                     ' '.join(run['machines'])))
+        return cur.lastrowid
+
+    def finish_run(self, run_id, finished):
+        with self.conn:
+            self.conn.execute("UPDATE runs SET finished = ? WHERE id = ?",
+                    (finished, run_id))
+
+    def update_recipe(self, run_id, record):
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO recipes VALUES " \
+                    "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (run_id, record['pn'], record['status'],
+                     record['error_class'], record['current_version'],
+                     record['next_version'], record['maintainer'],
+                     record['duration'], record['disk_used']))
+            self.conn.execute("DELETE FROM steps WHERE run_id = ? AND pn = ?",
+                    (run_id, record['pn']))
+            self.conn.executemany("INSERT INTO steps VALUES (?, ?, ?, ?)",
+                    [(run_id, record['pn'], step, duration) for step, duration
+                     in record['step_durations'].items()])
+
+    # runs without recipes (nothing to upgrade) don't count
+    def _last_runs(self, runs):
+        return "SELECT DISTINCT run_id FROM recipes " \
+               "ORDER BY run_id DESC LIMIT %d" % runs
+
+    def trends(self, pn, runs=RUNDB_QUERY_RUNS):
+        return self.conn.execute("SELECT runs.name, recipes.next_version, " \
+                "recipes.status, recipes.duration, recipes.disk_used " \
+                "FROM recipes JOIN runs ON runs.id = recipes.run_id " \
+                "WHERE recipes.pn = ? AND runs.id IN (%s) " \
+                "ORDER BY runs.id" % self._last_runs(runs), (pn,)).fetchall()
+
+    def _not_failures(self):
+        return "status NOT IN (%s)" % ', '.join('?' * len(RUNDB_NOT_FAILURES))
+
+    def failure_streaks(self, runs=RUNDB_QUERY_RUNS):
+        # consecutive failed attempts of every recipe up to its last one,
+        # as (version, failures), only the attempts of the version of the
+        # last one count
+        streaks = {}
+        for pn, status, version in self.conn.execute("SELECT pn, status, " \
+                "next_version FROM recipes WHERE run_id IN (%s) AND %s " \
+                "ORDER BY run_id DESC" % (self._last_runs(runs),
+                self._not_failures()), RUNDB_NOT_FAILURES):
+            streak = streaks.setdefault(pn, [version, 0, False])
+            if streak[2]:
+                continue
+            if status == "Succeeded" or version != streak[0]:
+                streak[2] = True
+            else:
+                streak[1] += 1
+
+        return dict((pn, (s[0], s[1])) for pn, s in streaks.items()
+                    if s[1] > 0)
+
+    def failures(self, runs=RUNDB_QUERY_RUNS):
+        # recipes that failed in every attempt of the last runs
+        return self.conn.execute("SELECT pn, COUNT(*), " \
+                "GROUP_CONCAT(DISTINCT error_class) FROM recipes " \
+                "WHERE run_id IN (%s) AND %s GROUP BY pn " \
+                "HAVING COUNT(*) > 1 AND SUM(status = 'Succeeded') = 0 " \
+                "ORDER BY COUNT(*) DESC, pn" % (self._last_runs(runs),
+                self._not_failures()), RUNDB_NOT_FAILURES).fetchall()
+
+    def regressions(self, runs=RUNDB_QUERY_RUNS,
+            factor=RUNDB_REGRESSION_FACTOR):
+        # recipes slower in the last run than its average in previous runs
+        return self.conn.execute("SELECT last.pn, last.duration, " \
+                "AVG(prev.duration) FROM recipes AS last " \
+                "JOIN recipes AS prev ON prev.pn = last.pn " \
+                "AND prev.run_id < last.run_id " \
+                "WHERE last.run_id = (SELECT MAX(run_id) FROM recipes) " \
+                "AND prev.run_id IN (%s) AND prev.duration > 0 " \
+                "GROUP BY last.pn HAVING last.duration > ? * AVG(prev.duration) " \
+                "ORDER BY last.duration / AVG(prev.duration) DESC" %
+                self._last_runs(runs + 1), (factor,)).fetchall()
+
+    def close(self):
+        self.conn.close()
+
+def print_query(db, query, pn=None, runs=RUNDB_QUERY_RUNS):
+    if query == "trends":
+        print("%-16s %-16s %-32s %10s %12s" % ("RUN", "VERSION", "STATUS",
+            "DURATION", "DISK USED"))
+        for run, version, status, duration, disk_used in db.trends(pn, runs):
+            print("%-16s %-16s %-32s %10.1f %12s" % (run, version, status,
+                duration or 0, disk_used if disk_used is not None else '-'))
+    elif query == "failures":
+        print("%-32s %8s %s" % ("RECIPE", "FAILURES", "ERRORS"))
+        for pn, count, errors in db.failures(runs):
+            print("%-32s %8d %s" % (pn, count, errors or ''))
+    elif query == "regressions":
+        print("%-32s %10s %10s" % ("RECIPE", "LAST", "AVERAGE"))
+        for pn, last, average in db.regressions(runs):
+            print("%-32s %10.1f %10.1f" % (pn, last, average))
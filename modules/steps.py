@@ -51,7 +51,12 @@ def clean_repo(bb, git, opts, pkg_ctx):
     git.create_branch("upgrades")
 
 def load_env(bb, git, opts, pkg_ctx):
-    stdout = git.status()
+    pkg_ctx['env'] = bb.env(pkg_ctx['PN'])
+    pkg_ctx['recipe_dir'] = os.path.dirname(pkg_ctx['env']['FILE'])
+
+    # only the recipe directory is checked and cleaned, scanning the
+    # whole tree is expensive when it has build artifacts
+    stdout = git.status([pkg_ctx['recipe_dir']])
     if stdout != "":
         if opts['interactive']:
             W(" %s: git repository has uncommited work which will be dropped!" \
@@ -62,37 +67,40 @@ def load_env(bb, git, opts, pkg_ctx):
                 exit(1)
 
         I(" %s: Dropping uncommited work!" % pkg_ctx['PN'])
-        git.reset_hard()
-        git.clean_untracked()
+        git.restore([pkg_ctx['recipe_dir']])
+        git.clean_untracked([pkg_ctx['recipe_dir']])
+        pkg_ctx['env'] = bb.env(pkg_ctx['PN'])
 
-    pkg_ctx['env'] = bb.env(pkg_ctx['PN'])
+    pkg_ctx['PV'] = pkg_ctx['env']['PV']
     pkg_ctx['workdir'] = os.path.join(pkg_ctx['base_dir'], pkg_ctx['PN'])
     os.mkdir(pkg_ctx['workdir'])
-    pkg_ctx['recipe_dir'] = os.path.dirname(pkg_ctx['env']['FILE'])
 
     if pkg_ctx['env']['PV'] == pkg_ctx['NPV']:
         raise UpgradeNotNeededError
 
 def detect_recipe_type(bb, git, opts, pkg_ctx):
+    kwargs = {}
+
     if pkg_ctx['env']['SRC_URI'].find("ftp://") != -1 or  \
             pkg_ctx['env']['SRC_URI'].find("http://") != -1 or \
             pkg_ctx['env']['SRC_URI'].find("https://") != -1:
         recipe = Recipe
     elif pkg_ctx['env']['SRC_URI'].find("git://") != -1:
         recipe = GitRecipe
+        kwargs['tag_cache'] = opts['tag_cache']
     else:
         raise UnsupportedProtocolError
 
     pkg_ctx['recipe'] = recipe(pkg_ctx['env'], pkg_ctx['NPV'],
             opts['interactive'], pkg_ctx['workdir'],
-            pkg_ctx['recipe_dir'], bb, git)
+            pkg_ctx['recipe_dir'], bb, git, **kwargs)
 
 def buildhistory_init(bb, git, opts, pkg_ctx):
     if not opts['buildhistory']:
         return
 
     pkg_ctx['buildhistory'] = BuildHistory(bb, pkg_ctx['PN'],
-            pkg_ctx['workdir'])
+            pkg_ctx['workdir'], opts['buildhistory_git'])
     I(" %s: Initial buildhistory for %s ..." % (pkg_ctx['PN'],
             opts['machines']))
     pkg_ctx['buildhistory'].init(opts['machines'])
@@ -140,18 +148,23 @@ def compile(bb, git, opts, pkg_ctx):
         W(" %s: Compilation was skipped by user choice!")
         return
 
+    env = None
+    if opts['buildhistory']:
+        env = pkg_ctx['buildhistory'].get_env()
+
     for machine in opts['machines']:
         I(" %s: compiling for %s ..." % (pkg_ctx['PN'], machine))
-        pkg_ctx['recipe'].compile(machine)
+        pkg_ctx['recipe'].compile(machine, env)
+        pkg_ctx.setdefault('machines_built', []).append(machine)
         if opts['buildhistory']:
-            pkg_ctx['buildhistory'].add()
+            pkg_ctx['buildhistory'].add(machine)
 
 def buildhistory_diff(bb, git, opts, pkg_ctx):
     if not opts['buildhistory']:
         return
 
     I(" %s: Checking buildhistory ..." % pkg_ctx['PN'])
-    pkg_ctx['buildhistory'].diff()
+    pkg_ctx['buildhistory_summary'] = pkg_ctx['buildhistory'].diff()
 
 upgrade_steps = [
     (clean_repo, "Cleaning git repository of temporary branch ..."),
@@ -22,8 +22,15 @@
 #
 
 import os
+import re
 import sys
+import copy
+import json
+import time
 import shutil
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import logging as log
 from logging import debug as D
@@ -34,6 +41,58 @@ from logging import critical as C
 
 from errors import *
 from utils.bitbake import *
+from utils.artifacts import ArtifactStore
+
+# directory levels searched below the image work directory for logs
+LOG_SEARCH_DEPTH = 4
+# resources reserved for every machine tested in parallel, the image
+# build plus the QEMU instance
+TESTIMAGE_MACHINE_MEMORY = 4096 * 1024 * 1024
+TESTIMAGE_MACHINE_CPUS = 4
+
+# file under the base work directory with the last ptest results of every
+# recipe and machine, used to compare the results of new versions
+PTEST_BASELINE_FILE = "ptest_baseline.json"
+
+# lines of the testimage log sent in the emails, the results and failures
+# or the tail of the log if none is found
+TESTIMAGE_EXCERPT_RE = re.compile("^(RESULTS|SUMMARY|Ran [0-9]+ test|OK|FAILED|" \
+        "FAIL:|ERROR:|Traceback|[A-Za-z]*Error)")
+TESTIMAGE_EXCERPT_LINES = 200
+TESTIMAGE_EXCERPT_TAIL = 50
+
+def _get_testimage_excerpt(log_file):
+    lines = []
+    tail = deque(maxlen=TESTIMAGE_EXCERPT_TAIL)
+
+    with open(log_file, "r", errors="replace") as f:
+        for line in f:
+            tail.append(line)
+            if len(lines) < TESTIMAGE_EXCERPT_LINES and \
+                    TESTIMAGE_EXCERPT_RE.match(line):
+                lines.append(line)
+
+    return lines or list(tail)
+
+def _compare_ptest_results(old, new):
+    changes = []
+    for key in ('pass', 'fail', 'skip'):
+        if old[key] != new[key]:
+            changes.append("%s %d -> %d" % (key.upper(), old[key], new[key]))
+
+    return ', '.join(changes)
+
+def _get_available_memory():
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                m = re.match("^MemAvailable:\s+([0-9]+) kB", line)
+                if m:
+                    return int(m.group(1)) * 1024
+    except IOError:
+        pass
+
+    return None
 
 def _pn_in_pkgs_ctx(pn, pkgs_ctx):
     for c in pkgs_ctx:
@@ -50,8 +109,29 @@ class TestImage():
         self.pkgs_ctx = args[0]['succeeded'][:]
         self.image = args[1]
 
+        self._image_dirs = {}
+        self._logs = {}
+        self._failed_build = None
+        self._rebuild_start = None
+        self._ctx_lock = threading.Lock()
+        self.artifacts = ArtifactStore(os.path.join(self.uh_work_dir,
+            "artifacts"))
+
+        # the work directories of the runs are under the base one
+        self._ptest_baseline_file = os.path.join(
+            os.path.dirname(self.uh_work_dir), PTEST_BASELINE_FILE)
+        self._ptest_baseline = {}
+        if os.path.exists(self._ptest_baseline_file):
+            try:
+                with open(self._ptest_baseline_file) as f:
+                    self._ptest_baseline = json.load(f)
+            except (IOError, ValueError):
+                W(" Can't load ptest baseline %s" % self._ptest_baseline_file)
+
         os.environ['BB_ENV_EXTRAWHITE'] = os.environ['BB_ENV_EXTRAWHITE'] + \
-            " TEST_SUITES CORE_IMAGE_EXTRA_INSTALL"
+            " TEST_SUITES CORE_IMAGE_EXTRA_INSTALL IMAGE_FEATURES_remove"
+        if 'TEST_SUITES' in os.environ:
+            del os.environ['TEST_SUITES']
 
     def _get_ptest_pkgs(self, pkgs_ctx):
         pkgs = []
@@ -102,41 +182,48 @@ class TestImage():
 
         return ok
  
-    def _parse_ptest_log(self, log_file):
-        ptest_results = {}
-
-        with open(log_file, "r") as f:
-            pn = None
-            processing = False
-
-            for line in f:
-                if not processing:
-                    m = re.search("^BEGIN: /usr/lib/(.*)/ptest$", line)
-                    if m:
-                        pn = m.group(1)
-                        ptest_results[pn] = []
-                        processing = True
-                else:
-                    m = re.search("^END: $", line)
-                    if m:
-                        pn = None
-                        processing = False
-                    else:
-                        ptest_results[pn].append(line)
-
-        return ptest_results
-
-    def _find_log(self, name, machine):
-        result = []
-
-        base_dir = os.path.join(os.getenv('BUILDDIR'), 'tmp', 'work')
+    def _walk_find(self, base_dir, name, machine, max_depth):
+        base_depth = base_dir.rstrip(os.sep).count(os.sep)
         for root, dirs, files in os.walk(base_dir):
-            if name in files:
-                result.append(os.path.join(root, name))
+            if name in files and machine in os.path.join(root, name):
+                return os.path.join(root, name)
+
+            if root.count(os.sep) - base_depth >= max_depth:
+                dirs[:] = []
+
+        return None
+
+    def _find_log(self, name, machine, image):
+        key = (image, machine, name)
+        log_file = self._logs.get(key)
+        if log_file and os.path.exists(log_file):
+            return log_file
+
+        if not (image, machine) in self._image_dirs:
+            env = self.bb.env(image, machine)
+            self._image_dirs[(image, machine)] = (env['WORKDIR'], env['T'])
+        workdir, tempdir = self._image_dirs[(image, machine)]
+
+        # logs of the image tasks are in T, the rest under the image
+        # WORKDIR, only if not there look at the work directories of
+        # the image for the machine
+        log_file = os.path.join(tempdir, name)
+        if not os.path.exists(log_file):
+            log_file = self._walk_find(workdir, name, '', LOG_SEARCH_DEPTH)
+        if log_file is None:
+            base_dir = os.path.join(self.bb.build_dir, 'tmp', 'work')
+            for arch_dir in os.listdir(base_dir):
+                image_dir = os.path.join(base_dir, arch_dir, image)
+                if os.path.isdir(image_dir):
+                    log_file = self._walk_find(image_dir, name, machine,
+                            LOG_SEARCH_DEPTH + 1)
+                    if log_file:
+                        break
+
+        if log_file:
+            self._logs[key] = log_file
 
-        for ptest_log in result:
-            if machine in ptest_log:
-                return ptest_log
+        return log_file
 
     def _get_failed_recipe(self, log):
         pn = None
@@ -174,79 +261,325 @@ class TestImage():
                         raise IntegrationError(e.stdout, pkg_ctx)
         raise e
 
-    def ptest(self, pkgs_ctx, machine):
-        image = 'core-image-minimal'
-        ptest_pkgs = self._get_ptest_pkgs(pkgs_ctx)
+    # the variables are passed per command instead of set in os.environ
+    # because machines can be tested in parallel
+    def _get_image_env(self, pkgs_ctx, ptest):
+        if ptest and not self.opts.get('testimage_combined'):
+            pkgs_ctx = self._get_ptest_pkgs(pkgs_ctx)
+
+        if not self.opts.get('testimage_combined'):
+            return {'CORE_IMAGE_EXTRA_INSTALL':
+                    self._get_pkgs_to_install(pkgs_ctx, ptest=ptest)}
+
+        # a combined image carries all the upgrades, only the ptest packages
+        # of the upgrades are installed instead of the ones of every recipe
+        # in the image so ptest-runner only runs them, the image provides
+        # its own ssh server
+        pkgs = [c['PN'] for c in pkgs_ctx]
+        ptest_pkgs = ["%s-ptest" % c['PN'] for c in
+                self._get_ptest_pkgs(pkgs_ctx)]
+        if ptest_pkgs:
+            pkgs += ["ptest-runner"] + ptest_pkgs
+
+        return {'CORE_IMAGE_EXTRA_INSTALL': ' '.join(pkgs),
+                'IMAGE_FEATURES_remove': "ptest-pkgs"}
+
+    def _build_image(self, image, pkgs_ctx, machine, ptest=False):
+        env = self._get_image_env(pkgs_ctx, ptest)
 
-        os.environ['CORE_IMAGE_EXTRA_INSTALL'] = \
-            self._get_pkgs_to_install(ptest_pkgs, ptest=True)
         I( "   building %s for %s ..." % (image, machine))
+        self._failed_build = None
         try:
-            self.bb.complete(image, machine)
+            self.bb.complete(image, machine, env)
         except Error as e:
+            self._failed_build = (image, machine, ptest)
             self._handle_image_build_error(image, pkgs_ctx, e)
+        finally:
+            if self._rebuild_start is not None:
+                elapsed = time.time() - self._rebuild_start
+                self._rebuild_start = None
+                I("   %s rebuild after cleanup took %d s" % (image, elapsed))
+                with open(os.path.join(self.uh_work_dir,
+                        "testimage_cleanup.log"), "a+") as f:
+                    f.write("%s: %s rebuild took %d s\n" % (machine, image,
+                        elapsed))
+
+    def _get_error_signature(self, stdout):
+        pn = self._get_failed_recipe(stdout)
+        if pn:
+            return pn
+
+        for line in stdout.splitlines():
+            if line.startswith("ERROR: "):
+                return line
+        return None
+
+    # returns None when the image builds, otherwise the signature of
+    # the error
+    def _try_build(self, image, pkgs_ctx, machine, ptest):
+        if not self.prepare_branch(pkgs_ctx):
+            return "can't prepare branch"
 
-        os.environ['TEST_SUITES'] = "ping ssh _ptest"
+        try:
+            self.bb.complete(image, machine,
+                    self._get_image_env(pkgs_ctx, ptest))
+        except Error as e:
+            return self._get_error_signature(e.stdout) or "unknown error"
+
+        return None
+
+    # finds the upgrades that break the image build testing halves of
+    # the set on top of the previous builds, sstate is reused so only
+    # the changed recipes are rebuilt
+    def _bisect(self, image, pkgs_ctx, machine, ptest):
+        culprits = []
+        bisect_log = os.path.join(self.uh_work_dir,
+                "testimage_bisect_%s.log" % machine)
+
+        def _test(pkgs):
+            error = self._try_build(image, pkgs, machine, ptest)
+            with open(bisect_log, "a+") as f:
+                f.write("%s %s: %s\n" % (image,
+                    "PASS" if error is None else "FAIL (%s)" % error,
+                    ' '.join([c['PN'] for c in pkgs]) or "<no upgrades>"))
+            return error
+
+        # returns True when the set breaks the build, if the first half
+        # builds the second one is known to fail without building it
+        def _search(pkgs, error=None):
+            if not pkgs:
+                return False
+            if error is None:
+                error = _test(pkgs)
+                if error is None:
+                    return False
+            if len(pkgs) == 1:
+                culprits.append((pkgs[0], error))
+                return True
+
+            half = len(pkgs) // 2
+            first_failed = _search(pkgs[:half])
+            _search(pkgs[half:], None if first_failed else error)
+            return True
+
+        # the failure must come from the upgrades, with a broken base
+        # every upgrade would look guilty
+        if _test([]) is not None:
+            E("   %s doesn't build for %s without the upgrades, " \
+                "not bisecting" % (image, machine))
+            return []
+
+        I("   bisecting %s build failure for %s with %d upgrades ..." %
+                (image, machine, len(pkgs_ctx)))
+        _search(pkgs_ctx, "full set")
+
+        # check the base again in case something else broke meanwhile
+        # (fetch outage, full disk, flaky task), then the failures of
+        # the upgrades can't be trusted
+        if culprits:
+            error = _test([])
+            if error is not None:
+                E("   %s stopped building for %s without the upgrades " \
+                    "(%s), bisection results discarded" % (image, machine,
+                    error))
+                return []
+
+        return [c for c, _ in culprits]
+
+    def _handle_bisect(self, e, machine):
+        image, machine, ptest = self._failed_build
+        self._failed_build = None
+
+        culprits = self._bisect(image, self.pkgs_ctx[:], machine, ptest)
+        if not culprits:
+            E("   %s build failure on machine %s can't be isolated" %
+                    (image, machine))
+            self.prepare_branch(self.pkgs_ctx)
+            return False
+
+        for pkg_ctx in culprits:
+            E("   %s on machine %s failed in integration, removing..."
+                % (pkg_ctx['PN'], machine))
+
+            with open(os.path.join(pkg_ctx['workdir'],
+                'integration_error.log'), 'a+') as f:
+                f.write(e.stdout)
+
+            pkg_ctx['integration_error'] = IntegrationError(e.stdout, pkg_ctx)
+            self.pkgs_ctx.remove(pkg_ctx)
+
+        # the artifacts to clean are the ones of the upgraded versions
+        if self.prepare_branch(culprits):
+            self._cleanup(culprits, image, machine)
+
+        return self.prepare_branch(self.pkgs_ctx)
+
+    def ptest(self, pkgs_ctx, machine):
+        image = 'core-image-minimal'
+
+        self._build_image(image, pkgs_ctx, machine, ptest=True)
+
+        env = self._get_image_env(pkgs_ctx, True)
+        env['TEST_SUITES'] = "ping ssh _ptest"
         I( "   running %s/ptest for %s ..." % (image, machine))
-        self.bb.complete("%s -c testimage" % image, machine)
+        self.bb.complete("%s -c testimage" % image, machine, env)
+
+        self._store_ptest_results(pkgs_ctx, machine, image)
+
+    # the ptest-runner output is processed in one pass, the section of
+    # every upgraded recipe is appended to its log as is read
+    def _parse_ptest_log(self, log_file, pkgs_ctx, machine):
+        ctxs = dict((c['PN'], c) for c in pkgs_ctx)
+        results = {}
+        pn = None
+        out = None
+
+        with open(log_file, "r") as f:
+            try:
+                for line in f:
+                    if pn is None:
+                        m = re.search("^BEGIN: /usr/lib/(.*)/ptest$", line)
+                        if m:
+                            pn = m.group(1)
+                            if pn in ctxs:
+                                pkg_ctx = ctxs[pn]
+                                if not 'ptest_log' in pkg_ctx:
+                                    pkg_ctx['ptest_log'] = os.path.join(
+                                        pkg_ctx['workdir'], "ptest.log")
+                                out = open(pkg_ctx['ptest_log'], "a+")
+                                out.write("BEGIN: PTEST for %s\n" % machine)
+                                results[pn] = {'pass': 0, 'fail': 0,
+                                               'skip': 0, 'duration': None}
+                        continue
+
+                    if line.startswith("END: "):
+                        if out is not None:
+                            r = results[pn]
+                            out.write("RESULT: PASS: %d FAIL: %d SKIP: %d\n" %
+                                    (r['pass'], r['fail'], r['skip']))
+                            out.write("END: PTEST for %s\n" % machine)
+                            out.close()
+                            out = None
+                        pn = None
+                        continue
+
+                    if out is None:
+                        continue
+
+                    out.write(line)
+                    m = re.match("^(PASS|FAIL|SKIP): ", line)
+                    if m:
+                        results[pn][m.group(1).lower()] += 1
+                        continue
+                    m = re.match("^DURATION: ([0-9]+)", line)
+                    if m:
+                        results[pn]['duration'] = int(m.group(1))
+            finally:
+                if out is not None:
+                    out.close()
 
-        ptest_log_file = self._find_log("ptest.log", machine)
+        return results
+
+    def _store_ptest_results(self, pkgs_ctx, machine, image):
+        ptest_log_file = self._find_log("ptest.log", machine, image)
         shutil.copyfile(ptest_log_file,
                 os.path.join(self.uh_work_dir, "ptest_%s.log" % machine))
 
-        ptest_result = self._parse_ptest_log(ptest_log_file)
-        for pn in ptest_result:
+        with self._ctx_lock:
+            results = self._parse_ptest_log(ptest_log_file, pkgs_ctx, machine)
+
+            baseline = self._ptest_baseline.setdefault(machine, {})
             for pkg_ctx in pkgs_ctx:
-                if not pn == pkg_ctx['PN']:
-                    continue 
+                pn = pkg_ctx['PN']
+                if not pn in results:
+                    continue
 
                 if not 'ptest' in pkg_ctx:
                     pkg_ctx['ptest'] = {}
-                if not 'ptest_log' in pkg_ctx:
-                    pkg_ctx['ptest_log'] = os.path.join(pkg_ctx['workdir'],
-                        "ptest.log")
-
+                    pkg_ctx['ptest_results'] = {}
                 pkg_ctx['ptest'][machine] = True
-                with open(pkg_ctx['ptest_log'], "a+") as f:
-                    f.write("BEGIN: PTEST for %s\n" % machine)
-                    for line in ptest_result[pn]:
-                        f.write(line)
-                    f.write("END: PTEST for %s\n" % machine)
+                pkg_ctx['ptest_results'][machine] = results[pn]
 
-    def testimage(self, pkgs_ctx, machine, image):
-        os.environ['CORE_IMAGE_EXTRA_INSTALL'] = \
-            self._get_pkgs_to_install(pkgs_ctx)
+                if pn in baseline and baseline[pn]['version'] != pkg_ctx['NPV']:
+                    changes = _compare_ptest_results(baseline[pn], results[pn])
+                    if changes:
+                        if results[pn]['fail'] > baseline[pn]['fail']:
+                            W("   %s ptest on %s has new failures: %s" %
+                                (pn, machine, changes))
+                        pkg_ctx.setdefault('ptest_changes', {})[machine] = \
+                            (baseline[pn]['version'], changes)
 
-        if 'TEST_SUITES' in os.environ:
-            del os.environ['TEST_SUITES']
+                baseline[pn] = dict(results[pn], version=pkg_ctx['NPV'])
 
-        I( "   building %s for %s ..." % (image, machine))
-        try:
-            self.bb.complete(image, machine)
-        except Error as e:
-            self._handle_image_build_error(image, pkgs_ctx, e)
+            with open(os.path.join(self.uh_work_dir,
+                    "ptest_results_%s.json" % machine), "w+") as f:
+                json.dump(results, f, indent=4, sort_keys=True)
+
+            with open(self._ptest_baseline_file + ".tmp", "w+") as f:
+                json.dump(self._ptest_baseline, f, indent=4, sort_keys=True)
+            os.rename(self._ptest_baseline_file + ".tmp",
+                    self._ptest_baseline_file)
+
+    def testimage(self, pkgs_ctx, machine, image):
+        self._build_image(image, pkgs_ctx, machine)
 
         I( "   running %s/testimage for %s ..." % (image, machine))
-        self.bb.complete("%s -c testimage" % image, machine)
+        self.bb.complete("%s -c testimage" % image, machine,
+                self._get_image_env(pkgs_ctx, False))
+
+        self._store_testimage_log(pkgs_ctx, machine, image)
+
+    def _store_testimage_log(self, pkgs_ctx, machine, image):
+        log_file = self._find_log("log.do_testimage", machine, image)
+
+        # the log is the same for all the recipes, it's stored once and
+        # linked from the recipe work directories, the recipe log only
+        # has the excerpt sent in the email
+        stored = self.artifacts.add(log_file, ".log")
+        name = "log_%s.do_testimage" % machine
+        self.artifacts.link(stored, os.path.join(self.uh_work_dir, name))
+        excerpt = _get_testimage_excerpt(stored)
 
-        log_file = self._find_log("log.do_testimage", machine)
-        shutil.copyfile(log_file,
-                os.path.join(self.uh_work_dir, "log_%s.do_testimage" % machine))
         for pkg_ctx in pkgs_ctx:
-            if not 'testimage' in pkg_ctx:
-                pkg_ctx['testimage'] = {}
-            if not 'testimage_log' in pkg_ctx:
-                pkg_ctx['testimage_log'] = os.path.join(
-                    pkg_ctx['workdir'], "log.do_testimage")
-
-            pkg_ctx['testimage'][machine] = True
-            with open(log_file, "r") as lf:
+            with self._ctx_lock:
+                if not 'testimage' in pkg_ctx:
+                    pkg_ctx['testimage'] = {}
+                    pkg_ctx['testimage_logs'] = {}
+                if not 'testimage_log' in pkg_ctx:
+                    pkg_ctx['testimage_log'] = os.path.join(
+                        pkg_ctx['workdir'], "log.do_testimage")
+
+                logs_dir = os.path.join(pkg_ctx['workdir'], "testimage")
+                if not os.path.exists(logs_dir):
+                    os.mkdir(logs_dir)
+                self.artifacts.link(stored, os.path.join(logs_dir, name))
+
+                pkg_ctx['testimage'][machine] = True
+                pkg_ctx['testimage_logs'][machine] = stored
                 with open(pkg_ctx['testimage_log'], "a+") as of:
                     of.write("BEGIN: TESTIMAGE for %s\n" % machine)
-                    for line in lf:
+                    of.write("Full log: %s\n" % os.path.join(logs_dir, name))
+                    for line in excerpt:
                         of.write(line)
                     of.write("END: TESTIMAGE for %s\n" % machine)
 
+    # builds only one image with the upgrades and their ptest packages and
+    # runs the default test suites and ptest in the same boot
+    def combined(self, pkgs_ctx, machine, image):
+        self._build_image(image, pkgs_ctx, machine, ptest=True)
+
+        ptest = len(self._get_ptest_pkgs(pkgs_ctx)) > 0
+        env = self._get_image_env(pkgs_ctx, True)
+        if ptest:
+            env['TEST_SUITES'] = "${DEFAULT_TEST_SUITES} _ptest"
+        I( "   running %s/testimage%s for %s ..." % (image,
+            " and ptest" if ptest else "", machine))
+        self.bb.complete("%s -c testimage" % image, machine, env)
+
+        if ptest:
+            self._store_ptest_results(pkgs_ctx, machine, image)
+        self._store_testimage_log(pkgs_ctx, machine, image)
+
     def _log_error(self, e):
         if isinstance(e, Error):
             E(" %s" % e.stdout)
@@ -255,9 +588,78 @@ class TestImage():
             tb = traceback.format_exc()
             E("%s" % tb)
 
+    def _get_rdepends(self, image, machine, pns):
+        try:
+            self.bb.dependency_graph(image, machine)
+        except Error as e:
+            W("     can't generate dependency graph of %s" % image)
+            return None
+
+        dependency_file = os.path.join(get_build_dir(), "pn-depends.dot")
+        if not os.path.exists(dependency_file):
+            return None
+
+        rdepends = {}
+        with open(dependency_file) as f:
+            for line in f:
+                m = re.search('^"(.*?)" -> "(.*?)"', line)
+                if m and m.group(1) != m.group(2):
+                    rdepends.setdefault(m.group(2), set()).add(m.group(1))
+
+        result = set()
+        pending = []
+        for pn in pns:
+            for p in (pn, pn + "-native"):
+                if p in rdepends or p == pn:
+                    result.add(p)
+                    pending.append(p)
+        while pending:
+            for r in rdepends.get(pending.pop(), ()):
+                if r not in result:
+                    result.add(r)
+                    pending.append(r)
+
+        return result
+
+    # cleans the sstate of the recipes and its reverse dependencies in the
+    # image, tmp and sstate are only removed as last resort
+    def _cleanup(self, pkgs_ctx, image, machine):
+        start = time.time()
+        free = shutil.disk_usage(get_build_dir()).free
+        cleaned = None
+
+        if self.opts.get('testimage_cleanup', 'targeted') == 'targeted':
+            pns = self._get_rdepends(image, machine, [c['PN'] for c in pkgs_ctx])
+            if pns:
+                I("     cleaning sstate of %s ..." % ' '.join(sorted(pns)))
+                try:
+                    self.bb.cleansstate(' '.join(sorted(pns)))
+                    cleaned = ' '.join(sorted(pns))
+                except Error as e:
+                    W("     cleansstate failed, removing tmp and sstate")
+
+        if cleaned is None:
+            I("     removing sstate directory ...")
+            shutil.rmtree(os.path.join(get_build_dir(), "sstate-cache"), True)
+            I("     removing tmp directory ...")
+            shutil.rmtree(os.path.join(get_build_dir(), "tmp"), True)
+            cleaned = "tmp sstate-cache"
+            self._image_dirs = {}
+            self._logs = {}
+
+        freed = shutil.disk_usage(get_build_dir()).free - free
+        elapsed = time.time() - start
+        I("     cleanup freed %d MB in %d s" % (freed / (1024 * 1024), elapsed))
+        with open(os.path.join(self.uh_work_dir, "testimage_cleanup.log"), "a+") as f:
+            f.write("%s: cleaned %s, freed %d bytes in %d s\n" %
+                (machine, cleaned, freed, elapsed))
+        self._rebuild_start = time.time()
+
     def _handle_error(self, e, machine):
         handled = True
 
+        # the culprit is already known when the build error names it,
+        # bisection is only needed otherwise
         if isinstance(e, IntegrationError):
             pkg_ctx = e.pkg_ctx
 
@@ -275,22 +677,175 @@ class TestImage():
             else:
                 pkg_ctx['integration_error'] = e
 
-                # remove previous build tmp, sstate to avoid QA errors
-                # on lower versions
-                I("     removing sstate directory ...")
-                shutil.rmtree(os.path.join(get_build_dir(), "sstate-cache"))
-                I("     removing tmp directory ...")
-                shutil.rmtree(os.path.join(get_build_dir(), "tmp"))
+                # remove previous build artifacts of the recipe to avoid
+                # QA errors on lower versions
+                if self._failed_build:
+                    image = self._failed_build[0]
+                else:
+                    image = self.image
+                self._cleanup([pkg_ctx], image, machine)
 
                 self.pkgs_ctx.remove(pkg_ctx)
 
                 if not self.prepare_branch(self.pkgs_ctx):
                     handled = False
+        elif self.opts.get('testimage_bisect') and self._failed_build and \
+                isinstance(e, Error):
+            handled = self._handle_bisect(e, machine)
         else:
             handled = False
 
         return handled
 
+    def _run_ptest(self, machine):
+        self.ptest(self.pkgs_ctx, machine)
+
+    def _run_testimage(self, machine):
+        self.testimage(self.pkgs_ctx, machine, self.image)
+
+    def _run_combined(self, machine):
+        self.combined(self.pkgs_ctx, machine, self.image)
+
+    def _get_tests(self):
+        if self.opts.get('testimage_combined'):
+            return [self._run_combined]
+
+        return [self._run_ptest, self._run_testimage]
+
+    def _run_test(self, test, machine):
+        while True:
+            try:
+                test(machine)
+                return True
+            except Exception as e:
+                if not self._handle_error(e, machine):
+                    E(" %s/testimage on machine %s failed" % (self.image, machine))
+                    self._log_error(e)
+                    return False
+
+    def _get_parallel_jobs(self):
+        jobs = len(self.opts['machines'])
+        if self.opts.get('testimage_jobs'):
+            jobs = min(jobs, self.opts['testimage_jobs'])
+
+        cpus = os.cpu_count() or 1
+        jobs = min(jobs, max(1, cpus // TESTIMAGE_MACHINE_CPUS))
+
+        memory = _get_available_memory()
+        if memory is not None:
+            jobs = min(jobs, max(1, memory // TESTIMAGE_MACHINE_MEMORY))
+
+        return jobs
+
+    # every machine is built in its own build directory including the
+    # configuration of the main one, only TMPDIR differs so sstate and
+    # downloads are shared
+    def _get_machine_bb(self, machine, base_env, threads):
+        build_dir = os.path.join(self.bb.build_dir, "testimage-%s" % machine)
+        conf_dir = os.path.join(build_dir, "conf")
+        if not os.path.exists(conf_dir):
+            os.makedirs(conf_dir)
+
+        main_conf_dir = os.path.join(self.bb.build_dir, "conf")
+        with open(os.path.join(main_conf_dir, "bblayers.conf")) as f:
+            bblayers = f.read().replace("${TOPDIR}", self.bb.build_dir)
+        with open(os.path.join(conf_dir, "bblayers.conf"), "w+") as f:
+            f.write(bblayers)
+
+        # bitbake.conf includes them from BBPATH, where the main build
+        # directory isn't
+        for name in ("site.conf", "auto.conf"):
+            conf_file = os.path.join(conf_dir, name)
+            if os.path.exists(os.path.join(main_conf_dir, name)):
+                with open(conf_file, "w+") as f:
+                    f.write("require %s\n" % os.path.join(main_conf_dir, name))
+            elif os.path.exists(conf_file):
+                os.remove(conf_file)
+
+        with open(os.path.join(conf_dir, "local.conf"), "w+") as f:
+            f.write("require %s\n" % os.path.join(main_conf_dir, "local.conf"))
+            f.write("TMPDIR = \"%s\"\n" % os.path.join(build_dir, "tmp"))
+            f.write("SSTATE_DIR = \"%s\"\n" % base_env['SSTATE_DIR'])
+            f.write("DL_DIR = \"%s\"\n" % base_env['DL_DIR'])
+            f.write("BB_NUMBER_THREADS = \"%d\"\n" % threads)
+            f.write("PARALLEL_MAKE = \"-j %d\"\n" % threads)
+
+        bb = Bitbake(build_dir)
+        bb.set_log_dir(self.bb.log_dir)
+        return bb
+
+    # every worker has its own state, only the contexts of the upgrades,
+    # written under _ctx_lock, are shared
+    def _get_worker(self, machine, base_env, threads):
+        worker = copy.copy(self)
+        worker.bb = self._get_machine_bb(machine, base_env, threads)
+        worker.pkgs_ctx = self.pkgs_ctx[:]
+        worker._image_dirs = {}
+        worker._logs = {}
+        worker._failed_build = None
+        worker._rebuild_start = None
+        return worker
+
+    # runs the tests of every machine concurrently without recovering from
+    # build errors, the tests of a machine whose image doesn't build are run
+    # again in the main build directory where integration errors are handled
+    def _run_parallel(self, jobs):
+        threads = max(1, (os.cpu_count() or 1) // jobs)
+        base_env = self.bb.env()
+
+        I(" Images will test for %s, %d machine(s) at a time." %
+                (', '.join(self.opts['machines']), jobs))
+
+        def _get_pns():
+            return [c['PN'] for c in self.pkgs_ctx]
+
+        def _test_machine(machine):
+            worker = self._get_worker(machine, base_env, threads)
+
+            I("  Testing images for %s in %s ..." % (machine,
+                worker.bb.build_dir))
+            tests = worker._get_tests()
+            for i, test in enumerate(tests):
+                try:
+                    test(machine)
+                except Exception as e:
+                    if worker._failed_build is None:
+                        E(" %s/testimage on machine %s failed" %
+                                (self.image, machine))
+                        self._log_error(e)
+                        continue
+
+                    D("  %s image build failed on %s in parallel: %s" %
+                            (test.__name__, machine, str(e)))
+                    return [t.__name__ for t in tests[i:]]
+            return []
+
+        # upgrades removed for breaking the build of a machine were in the
+        # images of the machines tested before, these are tested again
+        machines = self.opts['machines']
+        tested = {}
+        while machines and self.pkgs_ctx:
+            pns = _get_pns()
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                pending = list(executor.map(_test_machine, machines))
+
+            for machine, tests in zip(machines, pending):
+                tested[machine] = pns
+                if not tests:
+                    continue
+
+                I("  Testing images for %s again in %s ..." % (machine,
+                    self.bb.build_dir))
+                for test in tests:
+                    self._run_test(getattr(self, test), machine)
+                tested[machine] = _get_pns()
+
+            machines = [m for m in self.opts['machines']
+                        if tested[m] != _get_pns()]
+            if machines and self.pkgs_ctx:
+                I("  Testing images for %s again without the removed " \
+                    "upgrades ..." % ', '.join(machines))
+
     def run(self):
         if len(self.pkgs_ctx) <= 0:
             I(" Testimage was enabled but any upgrade was successful.")
@@ -299,25 +854,16 @@ class TestImage():
         if not self.prepare_branch(self.pkgs_ctx):
            return
 
+        if self.opts.get('testimage_parallel') and \
+                len(self.opts['machines']) > 1:
+            jobs = self._get_parallel_jobs()
+            if jobs > 1:
+                self._run_parallel(jobs)
+                return
+            I(" Not enough memory or CPUs to test machines in parallel.")
+
         I(" Images will test for %s." % ', '.join(self.opts['machines']))
         for machine in self.opts['machines']:
             I("  Testing images for %s ..." % machine)
-            while True:
-                try:
-                    self.ptest(self.pkgs_ctx, machine)
-                    break
-                except Exception as e:
-                    if not self._handle_error(e, machine):
-                        E(" %s/testimage on machine %s failed" % (self.image, machine))
-                        self._log_error(e)
-                        break
-
-            while True:
-                try:
-                    self.testimage(self.pkgs_ctx, machine, self.image)
-                    break
-                except Exception as e:
-                    if not self._handle_error(e, machine):
-                        E(" %s/testimage on machine %s failed" % (self.image, machine))
-                        self._log_error(e)
-                        break
+            for test in self._get_tests():
+                self._run_test(test, machine)
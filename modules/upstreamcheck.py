@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+# vim: set ts=4 sw=4 et:
+#
+# Copyright (c) 2015 Intel Corporation
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# This module implements an upstream version checker alternative to the
+# checkpkg task of distrodata, listing pages and git tags of all the
+# recipes are probed concurrently and the results are written in the
+# checkpkg.csv format.
+#
+
+import os
+import re
+import csv
+import json
+import hashlib
+import threading
+import urllib.request
+import urllib.error
+from urllib.parse import urljoin, urlparse
+from concurrent.futures import ThreadPoolExecutor
+
+from logging import debug as D
+from logging import info as I
+
+from errors import *
+
+# variables needed from every recipe
+CHECKER_VARS = ['PN', 'PV', 'PE', 'PR', 'SRC_URI', 'LICENSE', 'SECTION',
+                'HOMEPAGE', 'DEPENDS', 'BUGTRACKER', 'DESCRIPTION',
+                'RECIPE_MAINTAINER', 'RECIPE_NO_UPDATE_REASON',
+                'UPSTREAM_CHECK_URI', 'UPSTREAM_CHECK_REGEX',
+                'UPSTREAM_CHECK_GITTAGREGEX']
+
+CHECKPKG_HEADER = ['Package', 'Version', 'Upver', 'License', 'Section',
+                   'Home', 'Release', 'Depends', 'BugTracker', 'PE',
+                   'Description', 'Status', 'Tracking', 'URI', 'MAINTAINER',
+                   'NoUpReason']
+
+CHECKER_JOBS = 16
+CHECKER_HOST_JOBS = 4
+CHECKER_TIMEOUT = 30
+
+DEFAULT_GITTAGREGEX = r"(?P<pver>([0-9][\.|_]?)+)"
+# digits and dots, as the default of bitbake, pre-releases aren't proposed
+DEFAULT_TARBALL_PVER_REGEX = r"(?P<pver>[0-9]+(\.[0-9]+)*)"
+
+# suffixes of versions released before the one without them, 1.2rc1 < 1.2
+PRE_RELEASE_SUFFIXES = ('alpha', 'beta', 'pre', 'rc', 'dev')
+
+# numbers > other letters (1.2a > 1.2) > end of version > pre-releases
+def _version_key(version):
+    key = []
+    for part in re.findall("[0-9]+|[a-zA-Z]+", version):
+        if part.isdigit():
+            key.append((3, int(part), ''))
+        elif part.lower() in PRE_RELEASE_SUFFIXES:
+            key.append((0, 0, part.lower()))
+        else:
+            key.append((2, 0, part))
+    key.append((1, 0, ''))
+    return key
+
+def newest_version(versions):
+    newest = None
+    for v in versions:
+        if newest is None or _version_key(v) > _version_key(newest):
+            newest = v
+    return newest
+
+class UpstreamChecker(object):
+    def __init__(self, cache_dir, tag_cache, jobs=CHECKER_JOBS,
+            host_jobs=CHECKER_HOST_JOBS, timeout=CHECKER_TIMEOUT):
+        self.cache_dir = cache_dir
+        self.tag_cache = tag_cache
+        self.jobs = jobs
+        self.host_jobs = host_jobs
+        self.timeout = timeout
+
+        self.host_locks = {}
+        self.host_locks_lock = threading.Lock()
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _host_lock(self, url):
+        host = urlparse(url).hostname
+        with self.host_locks_lock:
+            if host not in self.host_locks:
+                self.host_locks[host] = threading.BoundedSemaphore(self.host_jobs)
+            return self.host_locks[host]
+
+    def _cache_file(self, url):
+        name = hashlib.sha1(url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, name + ".json")
+
+    def fetch_page(self, url):
+        cache_file = self._cache_file(url)
+        cached = None
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file) as f:
+                    cached = json.load(f)
+            except (IOError, ValueError):
+                cached = None
+
+        request = urllib.request.Request(url)
+        if cached:
+            if cached.get('etag'):
+                request.add_header('If-None-Match', cached['etag'])
+            if cached.get('last_modified'):
+                request.add_header('If-Modified-Since', cached['last_modified'])
+
+        with self._host_lock(url):
+            try:
+                response = urllib.request.urlopen(request, timeout=self.timeout)
+            except urllib.error.HTTPError as e:
+                if e.code == 304 and cached:
+                    return cached['body']
+                raise Error("Can't fetch %s: %s" % (url, str(e)))
+            except (urllib.error.URLError, IOError) as e:
+                raise Error("Can't fetch %s: %s" % (url, str(e)))
+
+            with response:
+                body = response.read().decode("utf-8", "replace")
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+
+        if etag or last_modified:
+            with open(cache_file + ".tmp", "w") as f:
+                json.dump({'url': url, 'etag': etag,
+                           'last_modified': last_modified, 'body': body}, f)
+            os.rename(cache_file + ".tmp", cache_file)
+
+        return body
+
+    def _get_links(self, page):
+        links = re.findall("href=[\"']?([^\"' >]+)", page, re.IGNORECASE)
+        return [l.rstrip('/').split('/')[-1] for l in links]
+
+    def _newest_version_dir(self, dir_url):
+        # directories with the version on it, e.g. .../1.2/foo-1.2.1.tar.gz
+        parent = dir_url.rstrip('/').rsplit('/', 1)[0] + '/'
+        current = dir_url.rstrip('/').rsplit('/', 1)[1]
+        shape = re.sub("[0-9]+", "[0-9]+", re.escape(current))
+
+        dirs = [l for l in self._get_links(self.fetch_page(parent))
+                if re.match("^" + shape + "$", l)]
+        newest = newest_version(dirs)
+        if newest is None:
+            return dir_url
+
+        return parent + newest + '/'
+
+    def _check_tarball(self, env, uri):
+        pv = env['PV']
+        name = os.path.basename(urlparse(uri).path)
+
+        if env.get('UPSTREAM_CHECK_URI'):
+            dir_url = env['UPSTREAM_CHECK_URI']
+        else:
+            dir_url = urljoin(uri, '.')
+            if re.search(r"[0-9]+(\.[0-9]+)+/$", dir_url):
+                dir_url = self._newest_version_dir(dir_url)
+
+        if env.get('UPSTREAM_CHECK_REGEX'):
+            regex = env['UPSTREAM_CHECK_REGEX']
+        elif pv in name:
+            prefix, suffix = name.split(pv, 1)
+            regex = "^" + re.escape(prefix) + DEFAULT_TARBALL_PVER_REGEX + \
+                    re.escape(suffix) + "$"
+        else:
+            raise Error("Can't build a version regex for %s" % name)
+
+        page = self.fetch_page(dir_url)
+        versions = []
+        for link in set(self._get_links(page)):
+            m = re.search(regex, link)
+            if m:
+                versions.append(m.group('pver'))
+
+        return newest_version(versions)
+
+    def _check_git(self, env, uri):
+        repo_url = uri.split(';')[0]
+        regex = env.get('UPSTREAM_CHECK_GITTAGREGEX') or DEFAULT_GITTAGREGEX
+
+        with self._host_lock(repo_url):
+            tags = self.tag_cache.get_index(repo_url)['tags']
+
+        versions = []
+        for tag in tags:
+            m = re.search(regex, tag)
+            if m:
+                versions.append(m.group('pver').replace('_', '.'))
+
+        return newest_version(versions)
+
+    def _check_recipe(self, env):
+        uri = ''
+        for u in env.get('SRC_URI', '').split():
+            if not u.startswith("file://"):
+                uri = u
+                break
+
+        cur_ver = env['PV'].split('+git')[0]
+        upver = None
+        try:
+            if uri.startswith("git://"):
+                upver = self._check_git(env, uri)
+            elif uri.split("://")[0] in ("http", "https", "ftp"):
+                upver = self._check_tarball(env, uri.split(';')[0])
+        except Error as e:
+            D(" %s: upstream check failed: %s" % (env['PN'], e.message))
+        except (IOError, OSError, ValueError) as e:
+            # a failing recipe mustn't abort the check of the rest
+            D(" %s: upstream check failed: %s" % (env['PN'], str(e)))
+
+        if upver is None:
+            status = "UNKNOWN"
+            upver = "N/A"
+        elif _version_key(upver) > _version_key(cur_ver):
+            status = "UPDATE"
+        elif _version_key(upver) == _version_key(cur_ver):
+            status = "MATCH"
+        else:
+            status = "UNKNOWN"
+
+        return [env['PN'], cur_ver, upver, env.get('LICENSE', ''),
+                env.get('SECTION', ''), env.get('HOMEPAGE', ''),
+                env.get('PR', ''), env.get('DEPENDS', ''),
+                env.get('BUGTRACKER', ''), env.get('PE', ''),
+                env.get('DESCRIPTION', ''), status, '', uri,
+                env.get('RECIPE_MAINTAINER', ''),
+                env.get('RECIPE_NO_UPDATE_REASON', '')]
+
+    def check(self, recipes_env):
+        I(" Checking upstream versions of %d recipe(s) ..." % len(recipes_env))
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            return list(executor.map(self._check_recipe, recipes_env))
+
+    def write_checkpkg_file(self, rows, file_path):
+        with open(file_path + ".tmp", "w+") as f:
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            writer.writerow(CHECKPKG_HEADER)
+            for row in rows:
+                writer.writerow([c.replace('\t', ' ').replace('\n', ' ')
+                                 for c in row])
+        os.rename(file_path + ".tmp", file_path)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# vim: set ts=4 sw=4 et:
+#
+# Copyright (c) 2015 Intel Corporation
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# This module implements a content addressed store for the artifacts of
+# a run, a file shared by several recipes is stored once and linked from
+# the work directory of every recipe.
+#
+
+import os
+import shutil
+import hashlib
+import threading
+
+class ArtifactStore(object):
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.lock = threading.Lock()
+
+        if not os.path.exists(self.store_dir):
+            os.makedirs(self.store_dir)
+
+    def _hash(self, file_path):
+        h = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def add(self, file_path, suffix=''):
+        stored = os.path.join(self.store_dir, self._hash(file_path) + suffix)
+
+        with self.lock:
+            if not os.path.exists(stored):
+                shutil.copyfile(file_path, stored + ".tmp")
+                os.rename(stored + ".tmp", stored)
+
+        return stored
+
+    def link(self, stored, dest):
+        if os.path.lexists(dest):
+            os.remove(dest)
+
+        try:
+            os.link(stored, dest)
+        except OSError:
+            # other filesystem
+            os.symlink(stored, dest)
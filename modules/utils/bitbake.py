@@ -63,10 +63,8 @@ class Bitbake(object):
         if output_filter is not None:
             cmd += ' |  grep ' + output_filter
 
-        os.chdir(self.build_dir)
-
         try:
-            stdout, stderr = bb.process.run(cmd)
+            stdout, stderr = bb.process.run(cmd, cwd=self.build_dir)
         except bb.process.ExecutionError as e:
             D("%s returned:\n%s" % (cmd, e.__str__()))
 
@@ -84,8 +82,13 @@ class Bitbake(object):
     def get_stdout_log(self):
         return os.path.join(self.log_dir, BITBAKE_ERROR_LOG)
 
-    def env(self, recipe=None):
-        stdout = self._cmd(recipe, "-e", output_filter="-v \"^#\"")
+    def env(self, recipe=None, machine=None):
+        env_var = None
+        if machine is not None:
+            env_var = "MACHINE=" + machine
+
+        stdout = self._cmd(recipe, "-e", env_var=env_var,
+                output_filter="-v \"^#\"")
 
         assignment = re.compile("^([^ \t=]*)=(.*)")
         bb_env = dict()
@@ -109,7 +112,7 @@ class Bitbake(object):
         return self._cmd(recipe, "-c unpack")
 
     def checkpkg(self, recipe):
-        if recipe == "universe":
+        if recipe == "universe" or len(recipe.split()) > 1:
             return self._cmd(recipe, "-c checkpkg -k")
         else:
             return self._cmd(recipe, "-c checkpkg")
@@ -120,8 +123,18 @@ class Bitbake(object):
     def cleansstate(self, recipe):
         return self._cmd(recipe, "-c cleansstate")
 
-    def complete(self, recipe, machine):
-        return self._cmd(recipe, env_var="MACHINE=" + machine)
+    def complete(self, recipe, machine, env=None):
+        env_var = "MACHINE=" + machine
+        # quoted to pass references to other variables unexpanded
+        if env is not None:
+            for var in sorted(env):
+                env_var += " %s='%s'" % (var, env[var])
+
+        return self._cmd(recipe, env_var=env_var)
+
+    def dependency_graph(self, package_list, machine=None):
+        env_var = None
+        if machine is not None:
+            env_var = "MACHINE=" + machine
 
-    def dependency_graph(self, package_list):
-        return self._cmd(package_list, "-g")
+        return self._cmd(package_list, "-g", env_var=env_var)
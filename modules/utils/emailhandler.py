@@ -23,10 +23,15 @@
 #
 
 import os
+import atexit
+import threading
+import queue
 import logging as log
 from logging import error as E
 from logging import info as I
-from smtplib import SMTP
+from logging import debug as D
+from smtplib import SMTP, SMTPRecipientsRefused, SMTPSenderRefused, \
+        SMTPDataError
 import mimetypes
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
@@ -35,6 +40,16 @@ from email.generator import Generator
 import shutil
 from io import StringIO
 
+# seconds to wait for the mail server
+SMTP_TIMEOUT = 60
+# attempts to send a message, the session is reopened between them
+SMTP_SEND_ATTEMPTS = 2
+# messages built and waiting to be sent
+SMTP_QUEUE_SIZE = 16
+
+# messages are sent by a thread reusing one SMTP session, so the next
+# message is built while the previous one is sent, close() waits for
+# the queued messages and ends the session
 class Email(object):
     def __init__(self, settings):
         self.smtp_host = None
@@ -47,7 +62,7 @@ class Email(object):
                 self.smtp_port = 25
             elif len(smtp_entry) == 2:
                 self.smtp_host = smtp_entry[0]
-                self.smtp_port = smtp_entry[1]
+                self.smtp_port = int(smtp_entry[1])
         else:
             E(" smtp host not set! Sending emails disabled!")
 
@@ -56,8 +71,95 @@ class Email(object):
         else:
             E(" 'From' address not set! Sending emails disabled!")
 
+        self.smtp = None
+        self.queue = None
+        self.sender = None
+
+        atexit.register(self.close)
+
         super(Email, self).__init__()
 
+    def _connect(self):
+        D(" Connecting to %s:%s ..." % (self.smtp_host, self.smtp_port))
+        self.smtp = SMTP(self.smtp_host, self.smtp_port, timeout=SMTP_TIMEOUT)
+
+    def _disconnect(self, quit=True):
+        if self.smtp is None:
+            return
+
+        try:
+            if quit:
+                self.smtp.quit()
+        except Exception:
+            pass
+        finally:
+            self.smtp.close()
+            self.smtp = None
+
+    def _send(self, to_addr, msg_text):
+        error = None
+
+        for attempt in range(SMTP_SEND_ATTEMPTS):
+            try:
+                if self.smtp is None:
+                    self._connect()
+                self.smtp.sendmail(self.from_addr, to_addr, msg_text)
+                return True
+            except (SMTPRecipientsRefused, SMTPSenderRefused,
+                    SMTPDataError) as e:
+                # the server rejected the message, the session is still valid
+                error = e
+                break
+            except Exception as e:
+                # the session was dropped or couldn't be opened
+                error = e
+                self._disconnect(quit=False)
+
+        E("Could not send email to %s: %s" % (to_addr, str(error)))
+        return False
+
+    def _sender(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self._send(*item)
+
+        self._disconnect()
+
+    # returns False when the sender thread isn't running, then nothing
+    # empties the queue and put() would block forever once it's full
+    def _queue(self, item):
+        while self.sender.is_alive():
+            try:
+                self.queue.put(item, timeout=SMTP_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    # sends the messages left in the queue by a sender thread that died
+    def _drain(self):
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                self._send(*item)
+
+    def close(self):
+        if self.sender is None:
+            return
+
+        if self._queue(None):
+            self.sender.join()
+        self.sender = None
+
+        self._drain()
+        self._disconnect()
+
     def send_email(self, to_addr, subject, text, files=[], cc_addr=None):
         if self.smtp_host is None or self.from_addr is None:
             return 0
@@ -99,10 +201,14 @@ class Email(object):
         Generator(out, mangle_from_=False).flatten(msg)
         msg_text = out.getvalue()
 
-        try:
-            smtp = SMTP(self.smtp_host, self.smtp_port)
-            smtp.sendmail(self.from_addr, to_addr, msg_text)
-            smtp.close()
-        except Exception as e:
-            E("Could not send email: %s" % str(e))
+        if self.sender is None:
+            self.queue = queue.Queue(SMTP_QUEUE_SIZE)
+            self.sender = threading.Thread(target=self._sender)
+            self.sender.daemon = True
+            self.sender.start()
+
+        if not self._queue((to_addr, msg_text)):
+            E(" Email sender stopped, sending synchronously")
+            self._drain()
+            self._send(to_addr, msg_text)
 
@@ -23,86 +23,174 @@
 #
 
 import os
+import subprocess
+import threading
 import logging as log
 from logging import debug as D
 
-from utils.bitbake import *
+from errors import *
 
 class Git(object):
-    def __init__(self, dir):
+    def __init__(self, dir, untracked_cache=False):
         self.repo_dir = dir
-        super(Git, self).__init__()
+        self.untracked_cache = untracked_cache
+
+        # read queries are answered by long-lived cat-file processes
+        self._batch = {}
+        self._batch_lock = threading.Lock()
 
-    def _cmd(self, operation):
-        os.chdir(self.repo_dir)
+        super(Git, self).__init__()
 
-        cmd = "git " + operation
-        try:
-            stdout, stderr = bb.process.run(cmd)
-        except bb.process.ExecutionError as e:
-            D("%s returned:\n%s" % (cmd, e.__str__()))
-            raise Error("The following git command failed: " + operation,
-                        e.stdout, e.stderr)
+    def _git_args(self):
+        args = ["git"]
+        if self.untracked_cache:
+            args += ["-c", "core.untrackedCache=true"]
+        return args
+
+    def _cmd(self, args):
+        cmd = self._git_args() + args
+        p = subprocess.Popen(cmd, cwd=self.repo_dir, stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            D("%s returned:\n%s\n%s" % (' '.join(cmd), stdout, stderr))
+            raise Error("The following git command failed: " + ' '.join(args),
+                        stdout, stderr)
 
         return stdout
 
+    def _batch_process(self, mode):
+        p = self._batch.get(mode)
+        if p is None or p.poll() is not None:
+            p = subprocess.Popen(self._git_args() + ["cat-file", mode],
+                    cwd=self.repo_dir, stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            self._batch[mode] = p
+        return p
+
+    def _batch_query(self, mode, obj):
+        with self._batch_lock:
+            p = self._batch_process(mode)
+            try:
+                p.stdin.write(obj.encode("utf-8") + b"\n")
+                p.stdin.flush()
+                header = p.stdout.readline().decode("utf-8").split()
+                if len(header) != 3:
+                    raise Error("git cat-file %s: %s not found" % (mode, obj),
+                                ' '.join(header))
+
+                content = None
+                if mode == "--batch":
+                    content = p.stdout.read(int(header[2]))
+                    p.stdout.read(1)
+            except (IOError, ValueError) as e:
+                p.kill()
+                raise Error("git cat-file %s failed on %s" % (mode, obj),
+                            str(e))
+
+        return (header, content)
+
+    def close(self):
+        with self._batch_lock:
+            for p in self._batch.values():
+                if p.poll() is None:
+                    p.stdin.close()
+                    p.wait()
+            self._batch = {}
+
+    def _pathspec(self, paths):
+        if not paths:
+            return []
+
+        return ["--"] + list(paths)
+
+    def rev_parse(self, rev):
+        header, _ = self._batch_query("--batch-check", rev)
+        return header[0]
+
+    def show_object(self, obj):
+        _, content = self._batch_query("--batch", obj)
+        return content
+
     def mv(self, src, dest):
-        return self._cmd("mv -f " + src + " " + dest)
+        return self._cmd(["mv", "-f", src, dest])
 
     def stash(self):
-        return self._cmd("stash")
+        return self._cmd(["stash"])
+
+    def add(self, paths):
+        return self._cmd(["add", "-A"] + self._pathspec(paths))
+
+    def commit(self, commit_message, author=None, paths=None):
+        # when paths are given only changes on them are staged and
+        # committed, the rest of the work tree isn't scanned
+        if paths:
+            self.add(paths)
+            args = ["commit"]
+        else:
+            args = ["commit", "-a"]
 
-    def commit(self, commit_message, author=None):
         if author is None:
-            return self._cmd("commit -a -s -m \"" + commit_message + "\"")
+            return self._cmd(args + ["-s", "-m", commit_message])
         else:
-            return self._cmd("commit -a --author=\"" + author + "\" -m \"" + commit_message + "\"")
+            return self._cmd(args + ["--author=" + author, "-m", commit_message])
 
     def create_patch(self, out_dir):
-        return self._cmd("format-patch -M10 -1 -o " + out_dir)
+        return self._cmd(["format-patch", "-M10", "-1", "-o", out_dir])
 
     def apply_patch(self, patch_file):
-        return self._cmd("am %s" % patch_file)
+        return self._cmd(["am", patch_file])
 
     def abort_patch(self):
-        return self._cmd("am --abort")
+        return self._cmd(["am", "--abort"])
 
-    def status(self):
-        return self._cmd("status --porcelain")
+    def status(self, paths=None):
+        return self._cmd(["status", "--porcelain"] + self._pathspec(paths))
 
     def checkout_branch(self, branch_name):
-        return self._cmd("checkout " + branch_name)
+        return self._cmd(["checkout", branch_name])
 
     def create_branch(self, branch_name):
-        return self._cmd("checkout -b " + branch_name)
+        return self._cmd(["checkout", "-b", branch_name])
 
     def delete_branch(self, branch_name):
-        return self._cmd("branch -D " + branch_name)
+        return self._cmd(["branch", "-D", branch_name])
 
     def pull(self):
-        return self._cmd("pull")
+        return self._cmd(["pull"])
 
     def reset_hard(self, no_of_patches=0):
         if no_of_patches == 0:
-            return self._cmd("reset --hard HEAD")
+            return self._cmd(["reset", "--hard", "HEAD"])
         else:
-            return self._cmd("reset --hard HEAD~" + str(no_of_patches))
+            return self._cmd(["reset", "--hard", "HEAD~" + str(no_of_patches)])
 
     def reset_soft(self, no_of_patches):
-        return self._cmd("reset --soft HEAD~" + str(no_of_patches))
+        return self._cmd(["reset", "--soft", "HEAD~" + str(no_of_patches)])
+
+    def clean_untracked(self, paths=None):
+        return self._cmd(["clean", "-fd"] + self._pathspec(paths))
+
+    def restore(self, paths, rev="HEAD"):
+        return self._cmd(["checkout", rev] + self._pathspec(paths))
+
+    def diff_names(self, rev_from, rev_to):
+        return self._cmd(["diff", "--name-only", rev_from,
+            rev_to]).splitlines()
 
-    def clean_untracked(self):
-        return self._cmd("clean -fd")
+    def tag(self, tag_name, rev="HEAD"):
+        return self._cmd(["tag", "-f", tag_name, rev])
 
     def last_commit(self, branch_name):
-        return self._cmd("log --pretty=format:\"%H\" -1 " + branch_name)
+        return self.rev_parse(branch_name + "^{commit}")
 
     def ls_remote(self, repo_url=None, options=None, refs=None):
-        cmd = "ls-remote"
+        args = ["ls-remote"]
         if options is not None:
-            cmd += " " + options
+            args += options.split()
         if repo_url is not None:
-            cmd += " " + repo_url
+            args.append(repo_url)
         if refs is not None:
-            cmd += " " + refs
-        return self._cmd(cmd)
+            args += refs.split()
+        return self._cmd(args)
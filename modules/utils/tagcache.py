@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# vim: set ts=4 sw=4 et:
+#
+# Copyright (c) 2015 Intel Corporation
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# This module keeps an index of the tags of upstream git repositories,
+# the output of ls-remote is parsed once and cached on disk per repository
+# url so recipes sharing a repository don't query it again.
+#
+
+import os
+import re
+import json
+import time
+import hashlib
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+from logging import debug as D
+from logging import info as I
+
+from errors import *
+
+# seconds that a cached tag index is considered valid
+TAG_CACHE_TTL = 24 * 60 * 60
+# concurrent ls-remote queries, in total and against the same host
+PREFETCH_JOBS = 8
+PREFETCH_HOST_JOBS = 2
+
+def parse_ls_remote_tags(output):
+    tags = {}
+
+    for line in output.split('\n'):
+        fields = line.split()
+        if len(fields) != 2 or not fields[1].startswith("refs/tags/"):
+            continue
+
+        sha1 = fields[0]
+        name = fields[1][len("refs/tags/"):]
+        # peeled entries point to the commit instead of the tag object
+        if name.endswith("^{}"):
+            tags[name[:-3]] = sha1
+        else:
+            tags.setdefault(name, sha1)
+
+    return tags
+
+def build_tag_index(tags):
+    # tags are commonly prefixed, e.g. v1.10 or foo-1.10, index them
+    # also by the version part, every suffix starting by a digit after a
+    # separator or a 'v' is indexed because the prefix can have digits
+    # too, e.g. bzip2-1.0.8
+    versions = {}
+    for name in tags:
+        for m in re.finditer("(?:^|[-_/])v?(?=([0-9].*)$)", name):
+            version = m.group(1)
+            if version != name:
+                versions.setdefault(version, tags[name])
+
+    return {'tags': tags, 'versions': versions}
+
+def find_tag_sha1(index, tag):
+    if tag in index['tags']:
+        return index['tags'][tag]
+
+    return index['versions'].get(tag)
+
+class TagCache(object):
+    def __init__(self, git, cache_dir, ttl=TAG_CACHE_TTL):
+        self.git = git
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.indexes = {}
+        # one query per repository when used from several threads
+        self.url_locks = {}
+        self.url_locks_lock = threading.Lock()
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _cache_file(self, repo_url):
+        name = hashlib.sha1(repo_url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, name + ".json")
+
+    def _load(self, repo_url):
+        cache_file = self._cache_file(repo_url)
+        if not os.path.exists(cache_file):
+            return None
+
+        try:
+            with open(cache_file) as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if data.get('url') != repo_url or \
+                time.time() - data.get('timestamp', 0) > self.ttl:
+            return None
+
+        return data['tags']
+
+    def _store(self, repo_url, tags):
+        cache_file = self._cache_file(repo_url)
+        fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({'url': repo_url, 'timestamp': time.time(),
+                       'tags': tags}, f)
+        os.replace(tmp_file, cache_file)
+
+    def update(self, repo_url, ls_remote_output):
+        tags = parse_ls_remote_tags(ls_remote_output)
+        self._store(repo_url, tags)
+        self.indexes[repo_url] = build_tag_index(tags)
+
+    def is_cached(self, repo_url):
+        return repo_url in self.indexes or \
+                self._load(repo_url) is not None
+
+    def _url_lock(self, repo_url):
+        with self.url_locks_lock:
+            if repo_url not in self.url_locks:
+                self.url_locks[repo_url] = threading.Lock()
+            return self.url_locks[repo_url]
+
+    def get_index(self, repo_url):
+        if repo_url in self.indexes:
+            return self.indexes[repo_url]
+
+        with self._url_lock(repo_url):
+            # other thread could have fetched it meanwhile
+            if repo_url in self.indexes:
+                return self.indexes[repo_url]
+
+            tags = self._load(repo_url)
+            if tags is None:
+                D(" Fetching tags from %s ..." % repo_url)
+                self.update(repo_url, self.git.ls_remote(repo_url, "--tags"))
+            else:
+                D(" Using cached tags for %s ..." % repo_url)
+                self.indexes[repo_url] = build_tag_index(tags)
+
+        return self.indexes[repo_url]
+
+    def get_sha1(self, repo_url, tag):
+        return find_tag_sha1(self.get_index(repo_url), tag)
+
+    def prefetch(self, repo_urls, jobs=PREFETCH_JOBS, host_jobs=PREFETCH_HOST_JOBS):
+        repo_urls = [u for u in set(repo_urls) if not self.is_cached(u)]
+        if not repo_urls:
+            return
+
+        I(" Prefetching tags of %d git repositories ..." % len(repo_urls))
+
+        host_locks = {}
+        for repo_url in repo_urls:
+            host = urlparse(repo_url).hostname
+            if host not in host_locks:
+                host_locks[host] = threading.BoundedSemaphore(host_jobs)
+
+        def _ls_remote(repo_url):
+            with host_locks[urlparse(repo_url).hostname]:
+                return self.git.ls_remote(repo_url, "--tags")
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = dict((executor.submit(_ls_remote, u), u) for u in repo_urls)
+            for future in as_completed(futures):
+                repo_url = futures[future]
+                try:
+                    self.update(repo_url, future.result())
+                except Error as e:
+                    # the recipe will query it again when is upgraded
+                    D(" Prefetch of tags from %s failed:\n%s" %
+                            (repo_url, e.stdout))
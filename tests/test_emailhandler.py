@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# vim: set ts=4 sw=4 et:
+#
+# Copyright (c) 2015 Intel Corporation
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Checks the email sender against a minimal SMTP server listening on
+# localhost, run with:
+#   python3 -m unittest discover tests
+#
+
+import os
+import sys
+import threading
+import unittest
+import socketserver
+
+sys.path.insert(1, os.path.join(os.path.abspath(
+    os.path.dirname(__file__)), '..', 'modules'))
+
+import utils.emailhandler
+from utils.emailhandler import Email
+
+# answers just what smtplib sends, the first session is dropped after
+# drop_after messages when it's set
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def _reply(self, line):
+        self.wfile.write((line + "\r\n").encode("utf-8"))
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.sessions += 1
+            drop = server.drop_after and server.sessions == 1
+        sent = 0
+
+        self._reply("220 localhost ESMTP")
+        while True:
+            line = self.rfile.readline().decode("utf-8")
+            if not line:
+                return
+
+            cmd = line.strip().split(' ', 1)[0].upper()
+            if cmd in ("EHLO", "HELO"):
+                self._reply("250 localhost")
+            elif cmd in ("MAIL", "RCPT", "RSET", "NOOP"):
+                self._reply("250 OK")
+            elif cmd == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while True:
+                    line = self.rfile.readline().decode("utf-8")
+                    if not line or line == ".\r\n":
+                        break
+                    data.append(line)
+                with server.lock:
+                    server.messages.append(''.join(data))
+                sent += 1
+                if drop and sent == server.drop_after:
+                    # no reply, the client finds the session dropped
+                    return
+                self._reply("250 OK")
+            elif cmd == "QUIT":
+                self._reply("221 Bye")
+                return
+            else:
+                self._reply("502 Not implemented")
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, drop_after=0):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0),
+                SMTPHandler)
+        self.lock = threading.Lock()
+        self.sessions = 0
+        self.messages = []
+        self.drop_after = drop_after
+
+class EmailTest(unittest.TestCase):
+    def _start_server(self, drop_after=0):
+        self.server = SMTPServer(drop_after)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        return Email({'smtp': "127.0.0.1:%d" % self.server.server_address[1],
+                      'from': "uh@localhost"})
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _subjects(self):
+        return sorted(m.split("Subject: ", 1)[1].split("\n", 1)[0].strip()
+                      for m in self.server.messages)
+
+    def test_one_session(self):
+        email = self._start_server()
+        for i in range(5):
+            email.send_email("maintainer@localhost", "mail %d" % i, "body")
+        email.close()
+
+        self.assertEqual(self._subjects(), ["mail %d" % i for i in range(5)])
+        self.assertEqual(self.server.sessions, 1)
+
+    def test_reconnect(self):
+        email = self._start_server(drop_after=2)
+        for i in range(3):
+            email.send_email("maintainer@localhost", "mail %d" % i, "body")
+        email.close()
+
+        # the second message is received before the session is dropped
+        # and sent again in the new one
+        self.assertEqual(self.server.sessions, 2)
+        self.assertEqual(sorted(set(self._subjects())),
+                         ["mail %d" % i for i in range(3)])
+
+    def test_sender_stopped(self):
+        email = self._start_server()
+        # a sender thread that ends without emptying the queue
+        email._sender = lambda: None
+        queue_size = utils.emailhandler.SMTP_QUEUE_SIZE
+        for i in range(queue_size + 2):
+            email.send_email("maintainer@localhost", "mail %d" % i, "body")
+        email.close()
+
+        self.assertEqual(self._subjects(),
+                         sorted("mail %d" % i for i in range(queue_size + 2)))
+
+if __name__ == '__main__':
+    unittest.main()
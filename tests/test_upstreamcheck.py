@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# vim: set ts=4 sw=4 et:
+#
+# Copyright (c) 2015 Intel Corporation
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+#
+# Checks the native upstream version checker against directory listings
+# served from a temporary directory, run with:
+#   python3 -m unittest discover tests
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+import functools
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+sys.path.insert(1, os.path.join(os.path.abspath(
+    os.path.dirname(__file__)), '..', 'modules'))
+
+from upstreamcheck import *
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class UpstreamCheckTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.www_dir = os.path.join(self.tmp_dir, "www")
+        for path in ("foo/foo-1.2.tar.gz", "foo/foo-1.10.tar.gz",
+                     "foo/foo-1.9.tar.gz", "foo/foo-1.10.tar.gz.sig",
+                     "foo/foo-1.11rc1.tar.gz", "foo/foo-1.11-beta.tar.gz",
+                     "foo/xfoo-2.0.tar.gz",
+                     "bar/1.2/bar-1.2.1.tar.xz", "bar/1.3/bar-1.3.0.tar.xz",
+                     "bar/1.3/bar-1.3.2.tar.xz"):
+            file_path = os.path.join(self.www_dir, path)
+            if not os.path.exists(os.path.dirname(file_path)):
+                os.makedirs(os.path.dirname(file_path))
+            open(file_path, "w").close()
+
+        handler = functools.partial(QuietHandler, directory=self.www_dir)
+        self.server = HTTPServer(("127.0.0.1", 0), handler)
+        self.base_url = "http://127.0.0.1:%d" % self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.checker = UpstreamChecker(os.path.join(self.tmp_dir, "cache"),
+                None, jobs=2, host_jobs=2, timeout=10)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _env(self, pn, pv, uri):
+        return {'PN': pn, 'PV': pv, 'SRC_URI': uri, 'RECIPE_MAINTAINER': 'm'}
+
+    # pre-releases and tarballs of other names (xfoo) aren't proposed
+    def test_tarball(self):
+        row = self.checker._check_recipe(self._env("foo", "1.2",
+            self.base_url + "/foo/foo-1.2.tar.gz"))
+        self.assertEqual(row[0], "foo")
+        self.assertEqual(row[2], "1.10")
+        self.assertEqual(row[CHECKPKG_HEADER.index('Status')], "UPDATE")
+
+    def test_version_order(self):
+        self.assertEqual(newest_version(["1.10rc1", "1.10", "1.9"]), "1.10")
+        self.assertEqual(newest_version(["1.10rc1", "1.10rc2"]), "1.10rc2")
+        self.assertEqual(newest_version(["1.10beta", "1.10rc1"]), "1.10rc1")
+        self.assertEqual(newest_version(["1.2", "1.2a"]), "1.2a")
+
+    def test_version_directory(self):
+        row = self.checker._check_recipe(self._env("bar", "1.2.1",
+            self.base_url + "/bar/1.2/bar-1.2.1.tar.xz"))
+        self.assertEqual(row[2], "1.3.2")
+
+    def test_up_to_date(self):
+        row = self.checker._check_recipe(self._env("foo", "1.10",
+            self.base_url + "/foo/foo-1.10.tar.gz"))
+        self.assertEqual(row[CHECKPKG_HEADER.index('Status')], "MATCH")
+
+    def test_unreachable(self):
+        row = self.checker._check_recipe(self._env("baz", "1.0",
+            self.base_url + "/baz/baz-1.0.tar.gz"))
+        self.assertEqual(row[CHECKPKG_HEADER.index('Status')], "UNKNOWN")
+
+    def test_checkpkg_file(self):
+        rows = self.checker.check([self._env("foo", "1.2",
+            self.base_url + "/foo/foo-1.2.tar.gz")])
+        file_path = os.path.join(self.tmp_dir, "checkpkg.csv")
+        self.checker.write_checkpkg_file(rows, file_path)
+        with open(file_path) as f:
+            header = f.readline().rstrip('\n').split('\t')
+        self.assertEqual(header[0], "Package")
+        self.assertEqual(len(header), len(rows[0]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -44,6 +44,7 @@ import configparser as cp
 from datetime import datetime
 from datetime import date
 import shutil
+import time
 
 sys.path.insert(1, os.path.join(os.path.abspath(
     os.path.dirname(__file__)), 'modules'))
@@ -53,8 +54,14 @@ from errors import *
 from utils.git import Git
 from utils.bitbake import *
 from utils.emailhandler import Email
+from utils.tagcache import *
 
 from statistics import Statistics
+from results import Results
+from rundb import *
+from history import History
+from gating import UpgradeRules
+from upstreamcheck import *
 from steps import upgrade_steps
 from testimage import TestImage
 
@@ -70,11 +77,77 @@ help_text = """Usage examples:
 
 DEFAULT_TESTIMAGE = 'core-image-sato'
 
+# checkpkg.csv columns used, by header name and the position used when
+# the header doesn't have it
+CHECKPKG_COLUMNS = {
+    'pn': ('Package', 0),
+    'cur_ver': ('Version', 1),
+    'next_ver': ('Upver', 2),
+    'status': ('Status', 11),
+    'uri': ('URI', 13),
+    'maintainer': ('MAINTAINER', 14),
+    'no_upgrade_reason': ('NoUpReason', 15),
+}
+
+def read_checkpkg_file(file_path):
+    import csv
+
+    with open(file_path, "r") as f:
+        reader = csv.reader(f, delimiter='\t')
+
+        header = next(reader, None)
+        if header is None:
+            return
+
+        columns = {}
+        for field, (name, position) in CHECKPKG_COLUMNS.items():
+            if name in header:
+                columns[field] = header.index(name)
+            else:
+                columns[field] = position
+
+        for row in reader:
+            if not row:
+                continue
+
+            pkg = {'row': row, 'header': header}
+            for field, i in columns.items():
+                if i < len(row):
+                    pkg[field] = row[i]
+                else:
+                    pkg[field] = ''
+            yield pkg
+
+# the tinfoil API changed with multiconfig support (recipecaches and
+# parse_recipe), both versions are supported
+def get_recipecache(tinfoil):
+    if hasattr(tinfoil.cooker, 'recipecaches'):
+        return tinfoil.cooker.recipecaches['']
+
+    return tinfoil.cooker.recipecache
+
+def parse_recipe(tinfoil, pn):
+    if hasattr(tinfoil, 'parse_recipe'):
+        return tinfoil.parse_recipe(pn)
+
+    import bb.cache
+    import bb.providers
+
+    recipecache = get_recipecache(tinfoil)
+    fn = bb.providers.findBestProvider(pn, tinfoil.config_data, recipecache,
+            recipecache.pkg_pn)[3]
+    if fn is None:
+        raise Error("Can't find the recipe file of %s" % pn)
+
+    return bb.cache.Cache.loadDataFull(fn,
+            tinfoil.cooker.collection.get_file_appends(fn),
+            tinfoil.config_data)
+
 def parse_cmdline():
     parser = argparse.ArgumentParser(description='Package Upgrade Helper',
                                      formatter_class=argparse.RawTextHelpFormatter,
                                      epilog=help_text)
-    parser.add_argument("recipe", help="recipe to be upgraded")
+    parser.add_argument("recipe", nargs='?', help="recipe to be upgraded")
 
     parser.add_argument("-t", "--to_version",
                         help="version to upgrade the recipe to")
@@ -92,7 +165,18 @@ def parse_cmdline():
                         help="do not compile, just change the checksums, remove PR, and commit")
     parser.add_argument("-c", "--config-file", default=None,
                         help="Path to the configuration file. Default is $BUILDDIR/upgrade-helper/upgrade-helper.conf")
-    return parser.parse_args()
+    parser.add_argument("-q", "--query", default=None,
+                        choices=["trends", "failures", "regressions"],
+                        help="query the results of previous runs instead of upgrading,\n"
+                             "trends shows the runs of the recipe")
+    parser.add_argument("-r", "--runs", type=int, default=RUNDB_QUERY_RUNS,
+                        help="number of runs looked at by --query")
+
+    args = parser.parse_args()
+    if not args.recipe and (not args.query or args.query == "trends"):
+        parser.error("the recipe is required")
+
+    return args
 
 def parse_config_file(config_file):
     settings = dict()
@@ -147,11 +231,30 @@ class Updater(object):
 
         self._add_file_logger()
 
+        # one buildhistory repository for all the recipes of the run, the
+        # directory is passed to every bitbake command that records it
+        if self.opts['buildhistory']:
+            self.opts['buildhistory_dir'] = os.path.join(self.uh_work_dir,
+                    "buildhistory")
+            if not os.path.exists(self.opts['buildhistory_dir']):
+                os.mkdir(self.opts['buildhistory_dir'])
+            self.opts['buildhistory_git'] = Git(self.opts['buildhistory_dir'])
+            os.environ['BB_ENV_EXTRAWHITE'] = \
+                os.environ['BB_ENV_EXTRAWHITE'] + " BUILDHISTORY_DIR"
+
+        self.opts['tag_cache'] = TagCache(self.git,
+                os.path.join(self.uh_dir, "cache", "tags"),
+                int(settings.get('tags_cache_ttl', TAG_CACHE_TTL)))
+
         self.email_handler = Email(settings)
         self.statistics = Statistics()
+        self.rundb = RunDatabase(os.path.join(self.uh_dir, RUNDB_FILE))
+        self.results = Results(self.uh_work_dir, self.opts['machines'],
+                settings.get('results_csv', 'no') == 'yes', self.rundb)
 
     def _set_options(self, auto_mode, send_email, skip_compilation):
         self.opts = {}
+        untracked_cache = settings.get('git_untracked_cache', 'no') == 'yes'
         self.opts['layer_mode'] = settings.get('layer_mode', '')
         if self.opts['layer_mode'] == 'yes':
             def _layer_settings_error(setting):
@@ -164,12 +267,13 @@ class Updater(object):
                 if not self.opts[s]:
                     _layer_settings_error(s)
 
-            self.git = Git(self.opts['layer_dir'])
+            self.git = Git(self.opts['layer_dir'], untracked_cache)
             self.poky_git = Git(os.path.dirname(os.getenv('PATH', False).split(':')[0]))
             self.opts['machines'] = self.opts['layer_machines'].split()
         else:
             # XXX: assume that the poky directory is the first entry in the PATH
-            self.git = Git(os.path.dirname(os.getenv('PATH', False).split(':')[0]))
+            self.git = Git(os.path.dirname(os.getenv('PATH', False).split(':')[0]),
+                    untracked_cache)
             self.poky_git = None
             self.opts['machines'] = settings.get('machines',
                 'qemux86 qemux86-64 qemuarm qemumips qemuppc').split()
@@ -181,6 +285,15 @@ class Updater(object):
         self.opts['skip_compilation'] = skip_compilation
         self.opts['buildhistory'] = self._buildhistory_is_enabled()
         self.opts['testimage'] = self._testimage_is_enabled()
+        self.opts['testimage_bisect'] = \
+            settings.get('testimage_bisect', 'no') == 'yes'
+        self.opts['testimage_cleanup'] = settings.get('testimage_cleanup',
+            'targeted')
+        self.opts['testimage_parallel'] = \
+            settings.get('testimage_parallel', 'no') == 'yes'
+        self.opts['testimage_jobs'] = int(settings.get('testimage_jobs', '0'))
+        self.opts['testimage_combined'] = \
+            settings.get('testimage_combined', 'no') == 'yes'
 
     def _make_dirs(self, build_dir):
         self.uh_dir = os.path.join(build_dir, "upgrade-helper")
@@ -289,6 +402,18 @@ class Updater(object):
 
         return enabled
 
+    def _get_upstream_git_urls(self, pkgs_to_upgrade):
+        return []
+
+    def _prefetch_upstream_tags(self, pkgs_to_upgrade):
+        repo_urls = self._get_upstream_git_urls(pkgs_to_upgrade)
+        if not repo_urls:
+            return
+
+        self.opts['tag_cache'].prefetch(repo_urls,
+                int(settings.get('prefetch_jobs', PREFETCH_JOBS)),
+                int(settings.get('prefetch_host_jobs', PREFETCH_HOST_JOBS)))
+
     def _get_packages_to_upgrade(self, packages=None):
         if packages is None:
             I( "Nothing to upgrade")
@@ -322,12 +447,15 @@ class Updater(object):
             "The recipe *FAILED* in testimage integration. Attached is the log file.\n\n"
 
         testimage_ptest_info = \
-            "The recipe has ptest enabled and has been tested with core-image-minimal/ptest \n" \
+            "The recipe has ptest enabled and has been tested with %s/ptest \n" \
             "with the next machines %s. Attached is the log file.\n\n"
 
         testimage_info = \
             "The recipe has been tested using %s testimage and succeeded with \n" \
-            "the next machines %s. Attached is the log file.\n\n" \
+            "the next machines %s. Attached is an excerpt of the log file.\n\n" \
+
+        testimage_ptest_changes = \
+            "The ptest results changed from the last tested version:\n"
 
         mail_footer = \
             "Attached are the patch, license diff (if change) and bitbake log.\n" \
@@ -364,7 +492,18 @@ class Updater(object):
             else:
                 if 'ptest' in pkg_ctx:
                     machines = pkg_ctx['ptest'].keys()
-                    msg_body += testimage_ptest_info % machines
+                    if self.opts['testimage_combined']:
+                        ptest_image = settings.get('testimage_name',
+                            DEFAULT_TESTIMAGE)
+                    else:
+                        ptest_image = 'core-image-minimal'
+                    msg_body += testimage_ptest_info % (ptest_image, machines)
+                if 'ptest_changes' in pkg_ctx:
+                    msg_body += testimage_ptest_changes
+                    for machine in sorted(pkg_ctx['ptest_changes']):
+                        msg_body += "    %s (from %s): %s\n" % ((machine,) +
+                            pkg_ctx['ptest_changes'][machine])
+                    msg_body += "\n"
                 if 'testimage' in pkg_ctx:
                     machines = pkg_ctx['testimage'].keys()
                     msg_body += testimage_info % (settings.get('testimage_name', \
@@ -404,7 +543,8 @@ class Updater(object):
 
             if 'recipe' in pkg_ctx:
                 I(" %s: Auto commit changes ..." % pkg_ctx['PN'])
-                self.git.commit(pkg_ctx['recipe'].commit_msg, self.opts['author'])
+                self.git.commit(pkg_ctx['recipe'].commit_msg, self.opts['author'],
+                        [pkg_ctx['recipe_dir']])
 
                 stdout = self.git.create_patch(pkg_ctx['workdir'])
                 pkg_ctx['patch_file'] = stdout.strip()
@@ -421,7 +561,8 @@ class Updater(object):
             msg = ''
 
             for line in e.stdout.split("\n"):
-                if line.find("nothing to commit") == 0:
+                if line.find("nothing to commit") == 0 or \
+                        line.find("no changes added to commit") == 0:
                     msg = "Nothing to commit!"
                     I(" %s: %s" % (pkg_ctx['PN'], msg))
 
@@ -535,6 +676,8 @@ class Updater(object):
         pkgs_to_upgrade = self._get_packages_to_upgrade(package_list)
         total_pkgs = len(pkgs_to_upgrade)
 
+        self._prefetch_upstream_tags(pkgs_to_upgrade)
+
         pkgs_ctx = {}
 
         I(" ########### The list of recipes to be upgraded #############")
@@ -570,6 +713,8 @@ class Updater(object):
         for pn, _, _ in pkgs_to_upgrade:
             pkg_ctx = pkgs_ctx[pn]
             pkg_ctx['error'] = None
+            pkg_ctx['step_durations'] = {}
+            disk_free = shutil.disk_usage(get_build_dir()).free
 
             attempted_pkgs += 1
             I(" ATTEMPT PACKAGE %d/%d" % (attempted_pkgs, total_pkgs))
@@ -578,7 +723,12 @@ class Updater(object):
                 for step, msg in upgrade_steps:
                     if msg is not None:
                         I(" %s: %s" % (pkg_ctx['PN'], msg))
-                    step(self.bb, self.git, self.opts, pkg_ctx)
+                    start = time.time()
+                    try:
+                        step(self.bb, self.git, self.opts, pkg_ctx)
+                    finally:
+                        pkg_ctx['step_durations'][step.__name__] = \
+                            time.time() - start
                 succeeded_pkgs_ctx.append(pkg_ctx)
 
                 I(" %s: Upgrade SUCCESSFUL! Please test!" % pkg_ctx['PN'])
@@ -610,6 +760,18 @@ class Updater(object):
                     succeeded_pkgs_ctx.remove(pkg_ctx)
                     failed_pkgs_ctx.append(pkg_ctx)
 
+            # drop leftovers of this recipe so the next one starts from a
+            # clean recipe directory
+            if 'recipe_dir' in pkg_ctx:
+                try:
+                    self.git.clean_untracked([pkg_ctx['recipe_dir']])
+                except Error:
+                    pass
+
+            pkg_ctx['disk_used'] = disk_free - \
+                shutil.disk_usage(get_build_dir()).free
+            self.results.update(pkg_ctx)
+
         if self.opts['testimage']:
             ctxs = {}
             ctxs['succeeded'] = succeeded_pkgs_ctx
@@ -633,6 +795,9 @@ class Updater(object):
             self.statistics.update(pkg_ctx['PN'], pkg_ctx['NPV'],
                     pkg_ctx['MAINTAINER'], pkg_ctx['error'])
             self.pkg_upgrade_handler(pkg_ctx)
+            self.results.update(pkg_ctx)
+
+        self.results.finish()
 
         if attempted_pkgs > 0:
             publish_work_url = settings.get('publish_work_url', '')
@@ -658,6 +823,15 @@ class Updater(object):
             if self.opts['send_email']:
                 self.send_status_mail(statistics_summary)
 
+        self.email_handler.close()
+
+        # stop the git cat-file processes
+        self.git.close()
+        if self.poky_git:
+            self.poky_git.close()
+        if self.opts['buildhistory']:
+            self.opts['buildhistory_git'].close()
+
 class UniverseUpdater(Updater):
     def __init__(self, recipes=None):
         Updater.__init__(self, True, True)
@@ -671,18 +845,36 @@ class UniverseUpdater(Updater):
         else:
             self.recipes = recipes
 
+        self.upstream_uris = dict()
+
         # read history file
         self.history_file = os.path.join(get_build_dir(), "upgrade-helper", "history.uh")
-        self.history = dict()
-        if os.path.exists(self.history_file):
-            with open(self.history_file) as history_file:
-                for line in history_file:
-                    line = line.strip()
-                    self.history[line.split(',')[0]] = [line.split(',')[1],
-                                                        line.split(',')[2],
-                                                        line.split(',')[3],
-                                                        line.split(',')[4]]
-    def _get_recipes_by_layer(self):
+        self.history = History(self.history_file)
+        self.rules = UpgradeRules(settings, self.history,
+                self.rundb.failure_streaks())
+
+    def _get_recipes_by_layer_tinfoil(self):
+        import bb.tinfoil
+
+        recipes = set()
+        layer_dir = os.path.realpath(self.opts['layer_dir']) + os.sep
+
+        tinfoil = bb.tinfoil.Tinfoil()
+        try:
+            tinfoil.prepare(config_only=False)
+            for pn, fns in get_recipecache(tinfoil).pkg_pn.items():
+                for fn in fns:
+                    # virtual:native:/path/to/recipe.bb
+                    fn = fn.split(':')[-1]
+                    if os.path.realpath(fn).startswith(layer_dir):
+                        recipes.add(pn)
+                        break
+        finally:
+            tinfoil.shutdown()
+
+        return sorted(recipes)
+
+    def _get_recipes_by_layer_show_recipes(self):
         recipes = []
 
         recipe_regex = re.compile('^(?P<name>.*):$')
@@ -707,6 +899,47 @@ class UniverseUpdater(Updater):
 
         return recipes
 
+    def _get_layer_recipes_cache_key(self):
+        import hashlib
+
+        key = hashlib.sha1()
+        for git in (self.git, self.poky_git):
+            try:
+                key.update(git.last_commit("HEAD").encode("utf-8"))
+            except Error:
+                return None
+
+        bblayers_conf = os.path.join(get_build_dir(), "conf", "bblayers.conf")
+        with open(bblayers_conf, "rb") as f:
+            key.update(f.read())
+
+        return key.hexdigest()
+
+    def _get_recipes_by_layer(self):
+        import json
+
+        cache_file = os.path.join(self.uh_dir, "layer_recipes_%s.json" %
+                self.opts['layer_name'])
+        cache_key = self._get_layer_recipes_cache_key()
+
+        if cache_key and os.path.exists(cache_file):
+            with open(cache_file) as f:
+                cache = json.load(f)
+            if cache['key'] == cache_key:
+                I(" Using cached recipes of layer %s ..." % self.opts['layer_name'])
+                return cache['recipes']
+
+        try:
+            recipes = self._get_recipes_by_layer_tinfoil()
+        except ImportError:
+            recipes = self._get_recipes_by_layer_show_recipes()
+
+        if cache_key:
+            with open(cache_file, "w+") as f:
+                json.dump({'key': cache_key, 'recipes': recipes}, f)
+
+        return recipes
+
     def _update_master(self):
         if self.opts['layer_mode'] == 'yes':
             I(" Sync poky master ...")
@@ -741,11 +974,60 @@ class UniverseUpdater(Updater):
             I(" Removing tmp directory ...")
             shutil.rmtree(os.path.join(get_build_dir(), "tmp"))
 
-    def _check_upstream_versions(self):
+    def _get_recipes_env(self, recipes=None):
+        import bb.tinfoil
+
+        recipes_env = []
+
+        tinfoil = bb.tinfoil.Tinfoil()
+        try:
+            tinfoil.prepare(config_only=False)
+            if recipes is None:
+                recipes = get_recipecache(tinfoil).pkg_pn.keys()
+
+            for pn in recipes:
+                if pn.find("cross") != -1 or pn.find("native") != -1:
+                    continue
+                try:
+                    d = parse_recipe(tinfoil, pn)
+                except Exception as e:
+                    D(" %s: can't parse recipe: %s" % (pn, str(e)))
+                    continue
+
+                env = dict()
+                for var in CHECKER_VARS:
+                    env[var] = d.getVar(var, True) or ''
+                recipes_env.append(env)
+        finally:
+            tinfoil.shutdown()
+
+        return recipes_env
+
+    def _check_upstream_versions_native(self, recipes):
+        checker = UpstreamChecker(os.path.join(self.uh_dir, "cache", "upstream"),
+                self.opts['tag_cache'],
+                int(settings.get('upstream_check_jobs', CHECKER_JOBS)),
+                int(settings.get('upstream_check_host_jobs', CHECKER_HOST_JOBS)))
+
+        rows = checker.check(self._get_recipes_env(recipes))
+
+        log_dir = os.path.join(get_build_dir(), "tmp", "log")
+        if not os.path.exists(log_dir):
+            os.makedirs(log_dir)
+        checker.write_checkpkg_file(rows, os.path.join(log_dir, "checkpkg.csv"))
+
+    def _check_upstream_versions(self, recipes=None):
         I(" Fetching upstream version(s) ...")
 
-        if self.recipes:
-            recipe = " ".join(self.recipes)
+        if recipes is None:
+            recipes = self.recipes
+
+        if settings.get('upstream_checker', 'checkpkg') == 'native':
+            self._check_upstream_versions_native(recipes)
+            return
+
+        if recipes:
+            recipe = " ".join(recipes)
         else:
             recipe = 'universe'
 
@@ -760,85 +1042,46 @@ class UniverseUpdater(Updater):
                     exit(1)
 
     def _parse_checkpkg_file(self, file_path):
-        import csv
+        import json
 
-        pkgs_list = []
+        index = dict()
 
-        with open(file_path, "r") as f:
-            reader = csv.reader(f, delimiter='\t')
-            for row in reader:
-                if reader.line_num == 1: # skip header line
-                    continue
+        for pkg in read_checkpkg_file(file_path):
+            pn = pkg['pn']
+            cur_ver = pkg['cur_ver']
+            next_ver = pkg['next_ver']
+            status = pkg['status']
+            maintainer = pkg['maintainer']
+            no_upgrade_reason = pkg['no_upgrade_reason']
 
-                pn = row[0]
-                cur_ver = row[1]
-                next_ver = row[2]
-                status = row[11]
-                maintainer = row[14]
-                no_upgrade_reason = row[15]
+            self.upstream_uris[pn] = pkg['uri']
+            index[pn] = [next_ver, status, maintainer]
 
-                if status == 'UPDATE' and not no_upgrade_reason:
-                    pkgs_list.append((pn, next_ver, maintainer))
+            if status == 'UPDATE' and not no_upgrade_reason:
+                yield (pn, next_ver, maintainer)
+            else:
+                if no_upgrade_reason:
+                    D(" Skip package %s (status = %s, current version = %s," \
+                        " next version = %s, no upgrade reason = %s)" %
+                        (pn, status, cur_ver, next_ver, no_upgrade_reason))
                 else:
-                    if no_upgrade_reason:
-                        D(" Skip package %s (status = %s, current version = %s," \
-                            " next version = %s, no upgrade reason = %s)" %
-                            (pn, status, cur_ver, next_ver, no_upgrade_reason))
-                    else:
-                        D(" Skip package %s (status = %s, current version = %s," \
-                            " next version = %s)" %
-                            (pn, status, cur_ver, next_ver))
-        return pkgs_list
+                    D(" Skip package %s (status = %s, current version = %s," \
+                        " next version = %s)" %
+                        (pn, status, cur_ver, next_ver))
+
+        # compact copy of the results for other tools, PN -> [next version,
+        # status, maintainer]
+        index_file = os.path.join(get_build_dir(), "upgrade-helper",
+                "checkpkg_index.json")
+        with open(index_file + ".tmp", "w+") as f:
+            json.dump(index, f)
+        os.rename(index_file + ".tmp", index_file)
 
     # checks if maintainer is in whitelist and that the recipe itself is not
     # blacklisted: python, gcc, etc. Also, check the history if the recipe
     # hasn't already been tried
     def _pkg_upgradable(self, pn, next_ver, maintainer):
-        if not maintainer:
-            D(" Skipping upgrade of %s: no maintainer" % pn)
-            return False
-
-        if "blacklist" in settings:
-            for p in settings["blacklist"].split():
-                if p == pn:
-                    D(" Skipping upgrade of %s: blacklist" % pn)
-                    return False
-
-        if "maintainers_whitelist" in settings:
-            found = False
-            for m in settings["maintainers_whitelist"].split():
-                if maintainer.find(m) != -1:
-                    found = True
-                    break
-
-            if found == False:
-                D(" Skipping upgrade of %s: maintainer \"%s\" not in whitelist" %
-                        (pn, maintainer))
-                return False
-
-        if pn in self.history:
-            # did we already try this version?
-            if next_ver == self.history[pn][0]:
-                retry_delta = \
-                    date.toordinal(date.today()) - \
-                    date.toordinal(datetime.strptime(self.history[pn][2], '%Y-%m-%d'))
-                # retry recipes that had fetch errors or other errors after
-                # more than 30 days
-                if (self.history[pn][3] == str(FetchError()) or
-                        self.history[pn][3] == str(Error())) and retry_delta > 30:
-                    return True
-
-                D(" Skipping upgrade of %s: is in history and not 30 days passed" % pn)
-                return False
-
-        # drop native/cross/cross-canadian recipes. We deal with native
-        # when upgrading the main recipe but we keep away of cross* pkgs...
-        # for now
-        if pn.find("cross") != -1 or pn.find("native") != -1:
-            D(" Skipping upgrade of %s: is cross or native" % pn)
-            return False
-
-        return True
+        return self.rules.upgradable(pn, next_ver, maintainer)
 
     def _get_packages_to_upgrade(self, packages=None):
         last_date_checked = None
@@ -862,8 +1105,13 @@ class UniverseUpdater(Updater):
 
         if last_master_commit != cur_master_commit or last_date_checked != current_date or \
                 last_checkpkg_file is None:
-            self._check_upstream_versions()
-            last_checkpkg_file = os.path.realpath(get_build_dir() + "/tmp/log/checkpkg.csv")
+            if settings.get('checkpkg_incremental', 'no') == 'yes' and \
+                    not self.recipes:
+                last_checkpkg_file = self._incremental_checkpkg(
+                        last_master_commit, cur_master_commit)
+            else:
+                self._check_upstream_versions()
+                last_checkpkg_file = os.path.realpath(get_build_dir() + "/tmp/log/checkpkg.csv")
         else:
             I(" Using last checkpkg.csv file since last master commit and last"
               " check date are the same ...")
@@ -872,6 +1120,8 @@ class UniverseUpdater(Updater):
         for pkg in self._parse_checkpkg_file(last_checkpkg_file):
             if self._pkg_upgradable(pkg[0], pkg[1], pkg[2]):
                 pkgs_list.append(pkg)
+        self.rules.write_skipped(os.path.join(self.uh_work_dir,
+                "skipped_recipes"))
 
         # Update last_checkpkg_run only after the version check has been completed
         with open(get_build_dir() + "/upgrade-helper/last_checkpkg_run", "w+") as last_check:
@@ -880,17 +1130,194 @@ class UniverseUpdater(Updater):
 
         return pkgs_list
 
+    # returns the PNs of the recipes changed between two commits or None
+    # if the changes could affect any recipe
+    def _get_changed_recipes(self, rev_from, rev_to):
+        try:
+            changed_files = self.git.diff_names(rev_from, rev_to)
+        except Error:
+            return None
+
+        def _get_pn(name):
+            return name.rsplit('.', 1)[0].split('_')[0]
+
+        pns = set()
+        removed = set()
+        removed_dirs = set()
+        others = []
+        for f in changed_files:
+            if f.endswith(".bbclass") or f.endswith(".conf"):
+                return None
+
+            name = os.path.basename(f)
+            if name.endswith(".bb") or name.endswith(".bbappend"):
+                if os.path.exists(os.path.join(self.git.repo_dir, f)):
+                    pns.add(_get_pn(name))
+                elif name.endswith(".bb"):
+                    removed.add(_get_pn(name))
+                    removed_dirs.add(os.path.dirname(f))
+            else:
+                others.append(f)
+
+        recipe_dirs = set()
+        for f in others:
+            # files of removed recipes
+            if [d for d in removed_dirs if f.startswith(d + '/')] and \
+                    not os.path.exists(os.path.join(self.git.repo_dir,
+                        os.path.dirname(f))):
+                continue
+
+            # patches, inc files, etc, check all the recipes in the
+            # nearest directory containing recipes, changes outside of
+            # recipe directories (e.g. maintainers.inc) affect all of them
+            d = os.path.dirname(os.path.join(self.git.repo_dir, f))
+            while True:
+                if not d.startswith(self.git.repo_dir) or \
+                        d == self.git.repo_dir:
+                    D(" Incremental checkpkg: %s isn't in a recipe " \
+                      "directory" % f)
+                    return None
+                if d in recipe_dirs:
+                    break
+                if os.path.isdir(d):
+                    recipes = [r for r in os.listdir(d) if r.endswith(".bb")]
+                    if recipes:
+                        recipe_dirs.add(d)
+                        for r in recipes:
+                            pns.add(_get_pn(r))
+                        break
+                d = os.path.dirname(d)
+
+        # upgraded or moved recipes are still there
+        for d in removed_dirs:
+            d = os.path.join(self.git.repo_dir, d)
+            if os.path.isdir(d):
+                pns.update(_get_pn(r) for r in os.listdir(d)
+                        if r.endswith(".bb"))
+        removed -= pns
+
+        return (pns, removed)
+
+    def _merge_checkpkg_files(self, old_file, new_file, out_file,
+            removed=None):
+        import csv
+
+        header = None
+        rows = dict()
+        for file_path in (old_file, new_file):
+            if file_path is None:
+                continue
+            for pkg in read_checkpkg_file(file_path):
+                header = pkg['header']
+                rows[pkg['pn']] = pkg['row']
+
+        for pn in removed or []:
+            rows.pop(pn, None)
+
+        with open(out_file + ".tmp", "w+") as f:
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            writer.writerow(header)
+            for pn in sorted(rows):
+                writer.writerow(rows[pn])
+        os.rename(out_file + ".tmp", out_file)
+
+    def _incremental_checkpkg(self, last_master_commit, cur_master_commit):
+        checkpkg_file = os.path.join(get_build_dir(), "upgrade-helper", "checkpkg.csv")
+        dates_file = os.path.join(get_build_dir(), "upgrade-helper", "checkpkg_dates")
+        ttl = int(settings.get('checkpkg_ttl', 7))
+        today = date.toordinal(date.today())
+
+        checked = dict()
+        if os.path.exists(dates_file):
+            with open(dates_file) as f:
+                for line in f:
+                    pn, checked_date = line.strip().split(',')
+                    checked[pn] = date.toordinal(
+                        datetime.strptime(checked_date, '%Y-%m-%d'))
+
+        # checkpkg errors aren't fatal, remove the results of the last run
+        # so they can't be taken as the ones of this run
+        new_file = os.path.realpath(get_build_dir() + "/tmp/log/checkpkg.csv")
+        if os.path.exists(new_file):
+            os.remove(new_file)
+
+        changed = None
+        removed = set()
+        if os.path.exists(checkpkg_file) and last_master_commit:
+            changes = self._get_changed_recipes(last_master_commit,
+                    cur_master_commit)
+            if changes is not None:
+                changed, removed = changes
+
+        for pn in removed:
+            checked.pop(pn, None)
+
+        if changed is None:
+            recipes = None
+        else:
+            I(" Incremental checkpkg: %d recipe(s) removed" % len(removed))
+            known = set(pkg['pn'] for pkg in read_checkpkg_file(checkpkg_file))
+            for pn in sorted(changed - known):
+                W(" Incremental checkpkg: %s isn't in the last results, " \
+                  "checking it by its file name" % pn)
+
+            stale = [pn for pn in checked if today - checked[pn] > ttl]
+            recipes = sorted(changed.union(stale))
+            I(" Incremental checkpkg: %d changed, %d stale recipe(s) ..." %
+                (len(changed), len(stale)))
+            if recipes:
+                self._check_upstream_versions(recipes)
+                if not os.path.exists(new_file):
+                    W(" Incremental checkpkg failed, checking all the " \
+                      "recipes ...")
+                    recipes = None
+
+        if recipes is None:
+            I(" Incremental checkpkg: checking all the recipes ...")
+            self._check_upstream_versions()
+
+        if recipes is None or recipes:
+            if not os.path.exists(new_file):
+                C(" checkpkg didn't generate %s" % new_file)
+                exit(1)
+
+        if recipes is None:
+            shutil.copyfile(new_file, checkpkg_file)
+        elif recipes or removed:
+            self._merge_checkpkg_files(checkpkg_file,
+                    new_file if recipes else None, checkpkg_file, removed)
+
+        if recipes is None or recipes or removed:
+            if recipes is None or recipes:
+                for pkg in read_checkpkg_file(new_file):
+                    checked[pkg['pn']] = today
+
+            # recipes whose PN differs from the file name aren't checked
+            for pn in recipes or []:
+                if checked.get(pn) != today:
+                    W(" Incremental checkpkg: %s wasn't checked, its PN " \
+                      "may differ from the recipe file name" % pn)
+
+            with open(dates_file + ".tmp", "w+") as f:
+                for pn in sorted(checked):
+                    f.write("%s,%s\n" % (pn,
+                        date.fromordinal(checked[pn]).isoformat()))
+            os.rename(dates_file + ".tmp", dates_file)
+
+        return checkpkg_file
+
+    def _get_upstream_git_urls(self, pkgs_to_upgrade):
+        repo_urls = []
+
+        for pn, _, _ in pkgs_to_upgrade:
+            m = re.match(".*(git://[^ ;]*).*", self.upstream_uris.get(pn, ''))
+            if m:
+                repo_urls.append(m.group(1))
+
+        return repo_urls
+
     def _update_history(self, pn, new_ver, maintainer, upgrade_status):
-        with open(self.history_file + ".tmp", "w+") as tmp_file:
-            if os.path.exists(self.history_file):
-                with open(self.history_file) as history:
-                    for line in history:
-                        if not line.startswith(pn):
-                            tmp_file.write(line)
-            tmp_file.write(pn + "," + new_ver + "," + maintainer +
-                           "," + date.isoformat(date.today()) + "," +
-                           upgrade_status + "\n")
-        os.rename(self.history_file + ".tmp", self.history_file)
+        self.history.update(pn, new_ver, maintainer, upgrade_status)
 
     def pkg_upgrade_handler(self, pkg_ctx):
         super(UniverseUpdater, self).pkg_upgrade_handler(pkg_ctx)
@@ -928,6 +1355,13 @@ if __name__ == "__main__":
                     level=debug_levels[args.debug_level - 1])
     settings, maintainer_override = parse_config_file(args.config_file)
 
+    if args.query:
+        db = RunDatabase(os.path.join(get_build_dir(), "upgrade-helper",
+            RUNDB_FILE))
+        print_query(db, args.query, args.recipe, args.runs)
+        db.close()
+        exit(0)
+
     recipes = args.recipe.split()
 
     if len(recipes) == 1 and recipes[0] == "all":